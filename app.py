@@ -1,15 +1,52 @@
 # app.py - 餐飲點餐系統主程式
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_from_directory
+from flask import g
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import Session as OrmSession, defer
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+import cProfile
+import click
+import hashlib
+import http.client
+import io
+import ipaddress
+import itertools
 import json
+import logging
 import os
+import pstats
+import re
+import secrets
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+import numpy as np
+from PIL import Image, ImageOps
 from pytz import timezone
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
 
+# 部署在反向代理後方時，以 PROXY_FIX_X_FOR 指定會附加 X-Forwarded-For 的代理層數，
+# remote_addr 才會是實際用戶端位址；未設定時不信任 X-Forwarded-For（用戶端可任意偽造）
+PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR, x_proto=1)
+
 # 資料庫配置
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -22,8 +59,26 @@ def process_database_url():
 database_url = process_database_url()
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url or f'sqlite:///{os.path.join(basedir, "restaurant.db")}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+# 跨站表單送出的 POST 不帶 session cookie
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+
+class StoreRoutingSession(Session):
+    """訂單分區啟用時，將分區資料表（訂單、每日彙總）的查詢導向目前分店的資料庫"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            table = None
+            if mapper is not None:
+                table = inspect(mapper).local_table
+            elif clause is not None and hasattr(clause, 'name'):
+                table = clause
+            if table is not None and getattr(table, 'name', None) in STORE_PARTITIONED_TABLES:
+                engine = get_store_engine(current_store_id())
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': StoreRoutingSession})
 
 # 設置時區為 GMT+8
 tz = timezone('Asia/Taipei')
@@ -63,14 +118,12 @@ def api_my_orders():
     # 這裡應該根據會話或用戶身份獲取訂單
     # 由於我們沒有用戶系統，我們使用客戶姓名和電話來查找訂單
     # 在實際應用中，您可能需要用戶登入系統
-    orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
+    # 每筆都要回傳項目，連同 order_items 一次查出
+    orders = order_list_query().add_columns(Order.order_items).order_by(Order.created_at.desc()).limit(10).all()
     
     orders_data = []
     for order in orders:
-        try:
-            order_items = json.loads(order.order_items)
-        except:
-            order_items = []
+        order_items = parse_order_items(order.order_items)
         
         orders_data.append({
             'id': order.id,
@@ -87,13 +140,24 @@ def api_my_orders():
 
 
 # 資料庫模型
+class Store(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(30), unique=True, nullable=False)  # 網址與分區名稱使用的代碼
+    name = db.Column(db.String(100), nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, index=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     image_url = db.Column(db.String(200), default='https://via.placeholder.com/200x150?text=食物圖片')
     stock = db.Column(db.Integer, default=99)
     category = db.Column(db.String(50), default='主餐')
+    image_hash = db.Column(db.String(64), nullable=True)  # 本地縮圖的內容雜湊，尚未快取時為空
+    image_fetch_failures = db.Column(db.Integer, nullable=True)  # 背景下載連續失敗次數
+    image_fetch_retry_at = db.Column(db.DateTime, nullable=True)  # 下載失敗後，下次重試的時間（UTC）
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -103,9 +167,15 @@ class Order(db.Model):
     total_price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='待處理')  # 待處理/製作中/完成
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    cashier_id = db.Column(db.Integer, db.ForeignKey('cashier.id'), nullable=True)  # 處理訂單的收銀員
+    # 訂單可能存放在分店自己的資料庫，不宣告資料庫層級的外鍵
+    cashier_id = db.Column(db.Integer, nullable=True)  # 處理訂單的收銀員
     dine_in = db.Column(db.Boolean, default=True)  # True為內用，False為外帶
     notified = db.Column(db.Boolean, default=False)  # 是否已通知前端
+    store_id = db.Column(db.Integer, index=True)
+    idempotency_key = db.Column(db.String(64), index=True, unique=True)  # prepare_order 發出，防止重複送出
+
+    # 訂單列表依分店篩選並以下單時間排序
+    __table_args__ = (db.Index('ix_order_store_created_at', 'store_id', 'created_at'),)
 
 class Admin(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -118,7 +188,9 @@ class Cashier(db.Model):
     password_hash = db.Column(db.String(120), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    orders = db.relationship('Order', backref='cashier', lazy=True)
+    store_id = db.Column(db.Integer, index=True)
+    orders = db.relationship('Order', backref='cashier', lazy=True,
+                             primaryjoin='foreign(Order.cashier_id) == Cashier.id')
 
 class OperationLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -128,11 +200,63 @@ class OperationLog(db.Model):
     details = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # 日誌頁以 id 由新到舊做 keyset 分頁，篩選條件的索引都以 id 結尾
+    __table_args__ = (
+        db.Index('ix_operation_log_user', 'user_type', 'user_id', 'id'),
+        db.Index('ix_operation_log_action', 'action', 'id'),
+        db.Index('ix_operation_log_created_at', 'created_at'),
+    )
+
+class OperationLogArchive(db.Model):
+    """超過保留期限的操作日誌歸檔"""
+    id = db.Column(db.Integer, primary_key=True)  # 沿用原日誌 id
+    user_type = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(100), nullable=False)
+    details = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class SystemSetting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(50), unique=True, nullable=False)
     value = db.Column(db.String(200), nullable=False)
 
+class DailySales(db.Model):
+    """每日銷售彙總（以 UTC 日期區分），由背景任務重新計算"""
+    store_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.Date, primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    product_sales = db.Column(db.Text, nullable=False, default='{}')  # JSON: {商品ID: {name, quantity, revenue}}
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)  # 為空表示已失效，等待重新計算
+    invalidated_at = db.Column(db.DateTime, nullable=True)  # 最近一次失效的時間，重新計算時據此判斷是否又被異動
+
+class DemandRowsPatch(db.Model):
+    """項目被修改或刪除的訂單，各 worker 據此只重新展開這些訂單的預測資料"""
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (db.Index('ix_demand_rows_patch_store_id', 'store_id', 'id'),)
+
+class ScheduledJob(db.Model):
+    """背景任務的排程狀態，各 worker 以條件式 UPDATE 搶佔執行權，確保同一時間只執行一次"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    interval_seconds = db.Column(db.Integer, nullable=False)
+    next_run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(100), nullable=True)
+    last_started_at = db.Column(db.DateTime, nullable=True)
+    last_finished_at = db.Column(db.DateTime, nullable=True)
+    last_duration_ms = db.Column(db.Float, nullable=True)
+    last_status = db.Column(db.String(20), nullable=True)  # 成功/失敗
+    last_error = db.Column(db.Text, nullable=True)
+    run_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+    total_duration_ms = db.Column(db.Float, nullable=False, default=0)
+
 # 記錄操作日誌的函數
 def log_operation(user_type, user_id, action, details=None):
     log = OperationLog(
@@ -144,6 +268,1689 @@ def log_operation(user_type, user_id, action, details=None):
     db.session.add(log)
     db.session.commit()
 
+# 操作日誌保留
+OPERATION_LOG_RETENTION_DAYS = 90
+OPERATION_LOG_PRUNE_BATCH_SIZE = 500
+
+def prune_operation_logs(max_age_days=None, archive=None, batch_size=OPERATION_LOG_PRUNE_BATCH_SIZE, pause=0.05):
+    """刪除（或先歸檔再刪除）超過保留期限的操作日誌
+
+    每批只處理 batch_size 筆並立即提交，批次之間暫停 pause 秒，
+    避免長時間鎖住資料表影響登入、狀態更新等寫入。回傳處理的筆數。
+    """
+    if max_age_days is None:
+        max_age_days = get_setting('operation_log_retention_days')
+    if archive is None:
+        archive = get_setting('operation_log_archive')
+
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    total = 0
+    while True:
+        rows = OperationLog.query.filter(OperationLog.created_at < cutoff).order_by(
+            OperationLog.created_at).limit(batch_size).all()
+        if not rows:
+            break
+
+        if archive:
+            db.session.add_all([
+                OperationLogArchive(id=row.id, user_type=row.user_type, user_id=row.user_id,
+                                    action=row.action, details=row.details, created_at=row.created_at)
+                for row in rows
+            ])
+        OperationLog.query.filter(OperationLog.id.in_([row.id for row in rows])).delete(
+            synchronize_session=False)
+        db.session.commit()
+        db.session.expunge_all()
+
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+    return total
+
+@app.cli.command('prune-logs')
+def prune_logs_command():
+    """依系統設置的保留天數清理操作日誌"""
+    count = prune_operation_logs()
+    click.echo(f'已清理 {count} 筆操作日誌')
+
+# 系統設置快取
+# 所有設置一次載入記憶體並依 SETTING_TYPES 轉型；update_setting 會遞增 settings_version，
+# 各 worker 最多每 SETTINGS_CHECK_INTERVAL 秒比對一次版本，有變動才重新載入。
+# 分店專屬的設置以「設置項@分店ID」存放，讀取時優先於全域設置
+SETTINGS_CHECK_INTERVAL = 5
+SETTING_TYPES = {
+    'notification_timeout': (int, 10),
+    'operation_log_retention_days': (int, OPERATION_LOG_RETENTION_DAYS),
+    'operation_log_archive': (bool, True),
+    'report_cache_ttl_dashboard': (int, 10),
+    'report_cache_ttl_reports': (int, 60),
+    'report_cache_ttl_forecast': (int, 3600),
+}
+# 由系統維護的版本計數器，不開放透過 update_setting 修改
+VERSION_SETTING_KEYS = ('settings_version', 'catalog_version', 'stores_version')
+_settings_cache = {'version': None, 'values': None, 'checked_at': 0.0}
+_settings_cache_lock = threading.Lock()
+
+def bump_version_counter(key):
+    """遞增 SystemSetting 中的版本計數器，需與資料異動在同一個交易中提交"""
+    updated = SystemSetting.query.filter_by(key=key).update(
+        {SystemSetting.value: db.cast(db.cast(SystemSetting.value, db.Integer) + 1, db.String)},
+        synchronize_session=False
+    )
+    if not updated:
+        db.session.add(SystemSetting(key=key, value='1'))
+
+def read_version_counter(key):
+    return db.session.query(SystemSetting.value).filter_by(key=key).scalar() or '0'
+
+def parse_setting(key, raw):
+    """依 SETTING_TYPES 轉型，缺少或格式錯誤時回傳預設值"""
+    kind, default = SETTING_TYPES.get(key, (str, None))
+    if raw is None:
+        return default
+    try:
+        if kind is bool:
+            return str(raw).strip().lower() in ('1', 'true', 'yes', 'on')
+        return kind(raw)
+    except (TypeError, ValueError):
+        return default
+
+def _refresh_settings(force=False):
+    now = time.monotonic()
+    if not force and _settings_cache['values'] is not None \
+            and now - _settings_cache['checked_at'] < SETTINGS_CHECK_INTERVAL:
+        return _settings_cache['values']
+
+    with _settings_cache_lock:
+        if force or _settings_cache['values'] is None \
+                or now - _settings_cache['checked_at'] >= SETTINGS_CHECK_INTERVAL:
+            # 先讀版本再載入設置，避免把舊設置標記成新版本
+            version = read_version_counter('settings_version')
+            if force or version != _settings_cache['version'] or _settings_cache['values'] is None:
+                _settings_cache['values'] = {
+                    row.key: row.value for row in db.session.query(SystemSetting.key, SystemSetting.value)
+                }
+                _settings_cache['version'] = version
+            _settings_cache['checked_at'] = now
+        return _settings_cache['values']
+
+def store_setting_key(key, store_id):
+    return f'{key}@{store_id}'
+
+def get_setting(key, store_id=None):
+    values = _refresh_settings()
+    if store_id is None:
+        store_id = current_store_id()
+    raw = values.get(store_setting_key(key, store_id))
+    if raw is None:
+        raw = values.get(key)
+    return parse_setting(key, raw)
+
+def invalidate_settings():
+    """本 worker 下一次讀取設置時立即重新檢查版本"""
+    _settings_cache['checked_at'] = 0.0
+
+# 分店
+# 商品、訂單、收銀員與設置都依分店區分，目前分店由 session 決定（顧客選擇、收銀員所屬分店、
+# 管理員切換），背景任務以 store_context 指定。訂單分區方式由 STORE_PARTITION_MODE 決定：
+#   shared       所有分店共用主資料庫的資料表，以 store_id 欄位區分（預設）
+#   sqlite_files 總店以外的分店各自使用 instance/store_<代碼>.db
+# 另可用 STORE_DATABASE_URLS（JSON，分店代碼 -> 資料庫網址）為個別分店指定資料庫。
+# 分區的訂單編號從「分店ID × STORE_ORDER_ID_BLOCK」起算，與主資料庫及其他分店不重複；
+# 已有訂單留在主資料庫的分店不能改用分區（不會自動搬移），啟動時會拒絕並要求先搬移
+STORE_PARTITION_MODE = os.environ.get('STORE_PARTITION_MODE', 'shared')
+STORE_DATABASE_URLS = json.loads(os.environ.get('STORE_DATABASE_URLS') or '{}')
+STORE_PARTITIONED_TABLES = ('order', 'daily_sales')
+STORE_ORDER_ID_BLOCK = 10 ** 9
+STORES_CHECK_INTERVAL = 5
+DEFAULT_STORE_CODE = 'main'
+_current_store_id = ContextVar('current_store_id', default=None)
+_stores_cache = {'version': None, 'stores': None, 'checked_at': 0.0}
+_stores_cache_lock = threading.Lock()
+_store_engines = {}
+_store_engines_lock = threading.Lock()
+
+def _refresh_stores():
+    now = time.monotonic()
+    if _stores_cache['stores'] is not None and now - _stores_cache['checked_at'] < STORES_CHECK_INTERVAL:
+        return _stores_cache['stores']
+
+    with _stores_cache_lock:
+        if _stores_cache['stores'] is None or now - _stores_cache['checked_at'] >= STORES_CHECK_INTERVAL:
+            version = read_version_counter('stores_version')
+            if version != _stores_cache['version'] or _stores_cache['stores'] is None:
+                _stores_cache['stores'] = {
+                    row.id: {'id': row.id, 'code': row.code, 'name': row.name, 'is_active': row.is_active}
+                    for row in db.session.query(Store.id, Store.code, Store.name, Store.is_active).order_by(Store.id)
+                }
+                _stores_cache['version'] = version
+            _stores_cache['checked_at'] = now
+        return _stores_cache['stores']
+
+def invalidate_stores():
+    _stores_cache['checked_at'] = 0.0
+
+@app.template_global()
+def get_stores():
+    return list(_refresh_stores().values())
+
+def get_store(store_id):
+    return _refresh_stores().get(store_id)
+
+def get_store_by_code(code):
+    return next((store for store in _refresh_stores().values() if store['code'] == code), None)
+
+def get_default_store_id():
+    stores = _refresh_stores()
+    default = next((store for store in stores.values() if store['code'] == DEFAULT_STORE_CODE), None)
+    if default is None and stores:
+        default = next(iter(stores.values()))
+    return default['id'] if default else None
+
+def current_store_id():
+    store_id = _current_store_id.get()
+    return store_id if store_id is not None else get_default_store_id()
+
+@app.template_global()
+def current_store():
+    return get_store(current_store_id())
+
+@contextmanager
+def store_context(store_id):
+    """在請求以外（背景任務、跨店報表）指定目前分店"""
+    token = _current_store_id.set(store_id)
+    try:
+        yield
+    finally:
+        _current_store_id.reset(token)
+
+def store_query(model):
+    """只查詢目前分店的資料"""
+    return model.query.filter(model.store_id == current_store_id())
+
+def get_store_object_or_404(model, object_id):
+    return store_query(model).filter(model.id == object_id).first_or_404()
+
+def get_store_engine(store_id):
+    """回傳分店訂單分區的 engine，與主資料庫共用時回傳 None"""
+    store = get_store(store_id) if store_id is not None else None
+    if store is None:
+        return None
+    url = STORE_DATABASE_URLS.get(store['code'])
+    if url is None and STORE_PARTITION_MODE == 'sqlite_files' and store['code'] != DEFAULT_STORE_CODE:
+        url = f"sqlite:///{os.path.join(app.instance_path, 'store_' + store['code'] + '.db')}"
+    if url is None:
+        return None
+
+    engine = _store_engines.get(url)
+    if engine is None:
+        with _store_engines_lock:
+            engine = _store_engines.get(url)
+            if engine is None:
+                if url.startswith('sqlite:///'):
+                    os.makedirs(os.path.dirname(url[len('sqlite:///'):]) or '.', exist_ok=True)
+                engine = create_engine(url)
+                _store_engines[url] = engine
+    return engine
+
+def dispose_store_engines():
+    for engine in _store_engines.values():
+        engine.dispose()
+
+def _create_partition_order_table(engine, store_id):
+    """建立分區的訂單表，編號從 store_id × STORE_ORDER_ID_BLOCK 之後開始"""
+    base = store_id * STORE_ORDER_ID_BLOCK
+    if engine.dialect.name == 'sqlite':
+        if inspect(engine).has_table(Order.__tablename__):
+            return
+        # AUTOINCREMENT 才能以 sqlite_sequence 指定起始編號
+        table = Order.__table__.to_metadata(db.MetaData())
+        table.dialect_options['sqlite']['autoincrement'] = True
+        table.create(engine)
+        with engine.begin() as conn:
+            conn.execute(db.text("INSERT INTO sqlite_sequence(name, seq) VALUES (:name, :base)"),
+                         {'name': Order.__tablename__, 'base': base})
+    else:
+        Order.__table__.create(engine, checkfirst=True)
+        if engine.dialect.name == 'postgresql':
+            with engine.begin() as conn:
+                conn.execute(db.text(
+                    "SELECT setval(pg_get_serial_sequence('\"order\"', 'id'), :base) "
+                    "WHERE (SELECT coalesce(max(id), 0) FROM \"order\") < :base"
+                ), {'base': base})
+
+def init_store_partition(store_id):
+    """在分店的分區資料庫建立訂單相關資料表與搜尋索引"""
+    engine = get_store_engine(store_id)
+    if engine is None:
+        return
+    with db.engine.connect() as conn:
+        stranded = conn.execute(db.text('SELECT count(*) FROM "order" WHERE store_id = :store_id'),
+                                {'store_id': store_id}).scalar()
+    if stranded:
+        raise RuntimeError(f'分店 {store_id} 在主資料庫仍有 {stranded} 筆訂單，'
+                           f'改用分區前請先搬移至 {engine.url}，或維持 STORE_PARTITION_MODE=shared')
+    _create_partition_order_table(engine, store_id)
+    db.metadata.create_all(engine, tables=[db.metadata.tables[name] for name in STORE_PARTITIONED_TABLES])
+    with store_context(store_id):
+        ensure_columns(Order, engine)
+        ensure_columns(DailySales, engine)
+        for index in Order.__table__.indexes:
+            index.create(engine, checkfirst=True)
+        init_search_index(orders_only=True)
+
+@app.before_request
+def bind_current_store():
+    store_id = session.get('store_id')
+    if store_id is None or get_store(store_id) is None:
+        store_id = get_default_store_id()
+    g.store_token = _current_store_id.set(store_id)
+
+@app.teardown_request
+def unbind_current_store(exc):
+    token = g.pop('store_token', None)
+    if token is not None:
+        _current_store_id.reset(token)
+
+# 訂單列表
+# 列表頁只顯示編號、姓名、金額與狀態，以欄位投影查詢，不載入 order_items；
+# 每頁 ORDER_LIST_PAGE_SIZE 筆，以 before（上一頁最後一筆的編號）做 keyset 分頁；
+# 訂單項目在展開詳情時才以 load_order_items 依編號批次讀取
+ORDER_LIST_COLUMNS = (Order.id, Order.customer_name, Order.customer_phone, Order.total_price,
+                      Order.status, Order.created_at, Order.dine_in, Order.cashier_id)
+ORDER_ITEMS_BATCH_LIMIT = 100
+ORDER_LIST_PAGE_SIZE = 50
+
+def order_list_query():
+    """目前分店的訂單列表查詢，回傳只含 ORDER_LIST_COLUMNS 的資料列"""
+    return store_query(Order).with_entities(*ORDER_LIST_COLUMNS)
+
+def order_list_page(before_id=None, per_page=ORDER_LIST_PAGE_SIZE):
+    """由新到舊的一頁訂單，回傳 (訂單列表, 下一頁的 before)"""
+    query = order_list_query()
+    if before_id:
+        query = query.filter(Order.id < before_id)
+    orders = query.order_by(Order.id.desc()).limit(per_page + 1).all()
+    next_before = orders[per_page - 1].id if len(orders) > per_page else None
+    return orders[:per_page], next_before
+
+def parse_order_items(raw):
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return []
+
+def load_order_items(order_ids):
+    """一次讀取多筆訂單的項目，回傳 {訂單編號: 項目列表}"""
+    if not order_ids:
+        return {}
+    rows = store_query(Order).with_entities(Order.id, Order.order_items).filter(Order.id.in_(order_ids))
+    return {row.id: parse_order_items(row.order_items) for row in rows}
+
+@app.cli.command('bench-order-list')
+@click.option('--orders', 'order_count', default=1000000, show_default=True, help='測試訂單筆數')
+@click.option('--items', 'items_per_order', default=5, show_default=True, help='每筆訂單的項目數')
+def bench_order_list_command(order_count, items_per_order):
+    """在暫存的 SQLite 資料庫比較訂單列表的完整載入、defer 與欄位投影"""
+    sample_items = json.dumps([
+        {'id': i, 'name': f'測試商品{i}', 'price': 100 + i, 'quantity': 1, 'image_url': f'https://example.com/{i}.jpg'}
+        for i in range(items_per_order)
+    ])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        Order.__table__.create(engine)
+        started = datetime.utcnow() - timedelta(days=365)
+        with engine.begin() as conn:
+            for offset in range(0, order_count, 10000):
+                conn.execute(Order.__table__.insert(), [{
+                    'customer_name': f'顧客{n}', 'customer_phone': '0912345678', 'order_items': sample_items,
+                    'total_price': 500, 'status': '完成', 'created_at': started + timedelta(seconds=n * 30),
+                    'dine_in': True, 'notified': True, 'store_id': 1
+                } for n in range(offset, min(offset + 10000, order_count))])
+        click.echo(f'已建立 {order_count} 筆訂單，每筆 {len(sample_items)} bytes 的 order_items')
+
+        variants = [
+            ('完整載入', lambda s: s.query(Order)),
+            ('defer(order_items)', lambda s: s.query(Order).options(defer(Order.order_items))),
+            ('欄位投影', lambda s: s.query(*ORDER_LIST_COLUMNS)),
+        ]
+        for name, build in variants:
+            with OrmSession(engine) as bench_session:
+                tracemalloc.start()
+                t0 = time.perf_counter()
+                rows = build(bench_session).filter(Order.store_id == 1).order_by(Order.created_at.desc()).all()
+                elapsed = time.perf_counter() - t0
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                click.echo(f'{name:<20} {len(rows)} 筆  {elapsed * 1000:9.1f} ms  記憶體峰值 {peak / 1048576:8.1f} MB')
+                del rows
+        engine.dispose()
+
+# 搜尋索引
+# SQLite 使用 FTS5 trigram 分詞（可處理中文），由觸發器在新增/修改/刪除時同步；
+# trigram 無法查詢一兩個字的關鍵字，另建 *_chars 索引把每個字元拆成一個詞（unicode61），
+# 短關鍵字以片語查詢相鄰字元，不必掃描整張表；
+# PostgreSQL 使用 pg_trgm GIN 索引，直接對原表做 ILIKE 查詢，不需額外同步
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# 從 order_items JSON 取出商品名稱，以空白串接
+_ORDER_ITEM_NAMES_SQL = (
+    "(SELECT coalesce(group_concat(json_extract(value, '$.name'), ' '), '') "
+    "FROM json_each(CASE WHEN json_valid({row}.order_items) THEN {row}.order_items ELSE '[]' END))"
+)
+
+_SQLITE_ORDER_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE order_search USING fts5("
+    "customer_name, customer_phone, order_ref, item_names, store_id UNINDEXED, tokenize='trigram')",
+    f"""CREATE TRIGGER order_search_ai AFTER INSERT ON "order" BEGIN
+        INSERT INTO order_search(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        VALUES (new.id, new.customer_name, coalesce(new.customer_phone, ''), CAST(new.id AS TEXT),
+                {_ORDER_ITEM_NAMES_SQL.format(row='new')}, new.store_id);
+    END""",
+    """CREATE TRIGGER order_search_ad AFTER DELETE ON "order" BEGIN
+        DELETE FROM order_search WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER order_search_au AFTER UPDATE OF customer_name, customer_phone, order_items, store_id
+        ON "order" BEGIN
+        DELETE FROM order_search WHERE rowid = old.id;
+        INSERT INTO order_search(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        VALUES (new.id, new.customer_name, coalesce(new.customer_phone, ''), CAST(new.id AS TEXT),
+                {_ORDER_ITEM_NAMES_SQL.format(row='new')}, new.store_id);
+    END""",
+    # 建立索引時回填既有資料
+    f"""INSERT INTO order_search(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        SELECT o.id, o.customer_name, coalesce(o.customer_phone, ''), CAST(o.id AS TEXT),
+               {_ORDER_ITEM_NAMES_SQL.format(row='o')}, o.store_id
+        FROM "order" AS o""",
+]
+
+# 把文字拆成以空白分隔的單一字元，供 *_chars 索引使用
+_SPLIT_CHARS_SQL = (
+    "(WITH RECURSIVE i(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM i WHERE n < length({text})) "
+    "SELECT coalesce(group_concat(substr({text}, n, 1), ' '), '') FROM i)"
+)
+
+def _split_chars_sql(text):
+    return _SPLIT_CHARS_SQL.format(text=text)
+
+def _order_chars_values(row):
+    return ', '.join([
+        f'{row}.id',
+        _split_chars_sql(f'{row}.customer_name'),
+        _split_chars_sql(f"coalesce({row}.customer_phone, '')"),
+        _split_chars_sql(f'CAST({row}.id AS TEXT)'),
+        _split_chars_sql(_ORDER_ITEM_NAMES_SQL.format(row=row)),
+        f'{row}.store_id',
+    ])
+
+_SQLITE_ORDER_CHARS_DDL = [
+    "CREATE VIRTUAL TABLE order_search_chars USING fts5("
+    "customer_name, customer_phone, order_ref, item_names, store_id UNINDEXED, tokenize='unicode61')",
+    f"""CREATE TRIGGER order_search_chars_ai AFTER INSERT ON "order" BEGIN
+        INSERT INTO order_search_chars(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        VALUES ({_order_chars_values('new')});
+    END""",
+    """CREATE TRIGGER order_search_chars_ad AFTER DELETE ON "order" BEGIN
+        DELETE FROM order_search_chars WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER order_search_chars_au AFTER UPDATE OF customer_name, customer_phone, order_items, store_id
+        ON "order" BEGIN
+        DELETE FROM order_search_chars WHERE rowid = old.id;
+        INSERT INTO order_search_chars(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        VALUES ({_order_chars_values('new')});
+    END""",
+    f"""INSERT INTO order_search_chars(rowid, customer_name, customer_phone, order_ref, item_names, store_id)
+        SELECT {_order_chars_values('o')} FROM "order" AS o""",
+]
+
+_SQLITE_PRODUCT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE product_search USING fts5(name, category, store_id UNINDEXED, tokenize='trigram')",
+    """CREATE TRIGGER product_search_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_search(rowid, name, category, store_id)
+        VALUES (new.id, new.name, coalesce(new.category, ''), new.store_id);
+    END""",
+    """CREATE TRIGGER product_search_ad AFTER DELETE ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER product_search_au AFTER UPDATE OF name, category, store_id ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+        INSERT INTO product_search(rowid, name, category, store_id)
+        VALUES (new.id, new.name, coalesce(new.category, ''), new.store_id);
+    END""",
+    """INSERT INTO product_search(rowid, name, category, store_id)
+        SELECT id, name, coalesce(category, ''), store_id FROM product""",
+]
+
+def _product_chars_values(row):
+    return ', '.join([
+        f'{row}.id',
+        _split_chars_sql(f'{row}.name'),
+        _split_chars_sql(f"coalesce({row}.category, '')"),
+        f'{row}.store_id',
+    ])
+
+_SQLITE_PRODUCT_CHARS_DDL = [
+    "CREATE VIRTUAL TABLE product_search_chars USING fts5(name, category, store_id UNINDEXED, tokenize='unicode61')",
+    f"""CREATE TRIGGER product_search_chars_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_search_chars(rowid, name, category, store_id) VALUES ({_product_chars_values('new')});
+    END""",
+    """CREATE TRIGGER product_search_chars_ad AFTER DELETE ON product BEGIN
+        DELETE FROM product_search_chars WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER product_search_chars_au AFTER UPDATE OF name, category, store_id ON product BEGIN
+        DELETE FROM product_search_chars WHERE rowid = old.id;
+        INSERT INTO product_search_chars(rowid, name, category, store_id) VALUES ({_product_chars_values('new')});
+    END""",
+    f"""INSERT INTO product_search_chars(rowid, name, category, store_id)
+        SELECT {_product_chars_values('p')} FROM product AS p""",
+]
+
+_POSTGRES_ORDER_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # 需求預測展開 order_items 時使用，格式錯誤的 JSON 回傳 NULL 而不是讓整個查詢失敗
+    """CREATE OR REPLACE FUNCTION safe_jsonb(value text) RETURNS jsonb AS $$
+    BEGIN
+        RETURN value::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE""",
+    'CREATE INDEX IF NOT EXISTS ix_order_customer_name_trgm ON "order" USING gin (customer_name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_order_customer_phone_trgm ON "order" USING gin (customer_phone gin_trgm_ops)',
+    # order_items 以 json.dumps 存成 \uXXXX 跳脫字元，轉為 jsonb 後才是可搜尋的中文
+    'CREATE INDEX IF NOT EXISTS ix_order_order_items_trgm ON "order" '
+    'USING gin (((order_items::jsonb)::text) gin_trgm_ops)',
+]
+
+_POSTGRES_PRODUCT_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    'CREATE INDEX IF NOT EXISTS ix_product_name_trgm ON product USING gin (name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_product_category_trgm ON product USING gin (category gin_trgm_ops)',
+]
+
+def _init_search_table(model, fts_table, sqlite_ddl, postgres_ddl):
+    bind_arguments = {'mapper': model}
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect == 'sqlite':
+        columns = {row[1] for row in db.session.execute(
+            db.text(f"PRAGMA table_info({fts_table})"), bind_arguments=bind_arguments)}
+        if 'store_id' in columns:
+            return
+        if columns:
+            # 早期版本的索引沒有 store_id，刪除後重建
+            db.session.execute(db.text(f'DROP TABLE {fts_table}'), bind_arguments=bind_arguments)
+            for suffix in ('ai', 'ad', 'au'):
+                db.session.execute(db.text(f'DROP TRIGGER IF EXISTS {fts_table}_{suffix}'),
+                                   bind_arguments=bind_arguments)
+        for statement in sqlite_ddl:
+            db.session.execute(db.text(statement), bind_arguments=bind_arguments)
+        db.session.commit()
+    elif dialect == 'postgresql':
+        for statement in postgres_ddl:
+            db.session.execute(db.text(statement), bind_arguments=bind_arguments)
+        db.session.commit()
+
+def init_search_index(orders_only=False):
+    """建立搜尋索引（需在 app context 內、create_all 之後呼叫），訂單索引建立在目前分店的分區"""
+    _init_search_table(Order, 'order_search', _SQLITE_ORDER_SEARCH_DDL, _POSTGRES_ORDER_SEARCH_DDL)
+    _init_search_table(Order, 'order_search_chars', _SQLITE_ORDER_CHARS_DDL, [])
+    if not orders_only:
+        _init_search_table(Product, 'product_search', _SQLITE_PRODUCT_SEARCH_DDL, _POSTGRES_PRODUCT_SEARCH_DDL)
+        _init_search_table(Product, 'product_search_chars', _SQLITE_PRODUCT_CHARS_DDL, [])
+
+def _escape_like(keyword):
+    return keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _search_ids(fts_table, columns, model, model_columns, keyword, before_id, limit, exclude_id=None):
+    """依關鍵字搜尋目前分店的資料，回傳由新到舊排序的 id 列表（keyset 分頁，id < before_id）"""
+    store_id = current_store_id()
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect == 'sqlite':
+        params = {'before': before_id or -1, 'limit': limit, 'store_id': store_id, 'exclude': exclude_id or -1}
+        like = '(' + ' OR '.join(f"s.{col} LIKE :like ESCAPE '\\'" for col in columns) + ')'
+        params['like'] = f'%{_escape_like(keyword)}%'
+        source, row = f'{fts_table} AS s', 's'
+        if len(keyword) >= 3:
+            # trigram 需至少三個字元才能走索引
+            condition = f's.{fts_table} MATCH :q'
+            params['q'] = '"' + keyword.replace('"', '""') + '"'
+        elif any(ch.isalnum() for ch in keyword):
+            # 一兩個字改查逐字索引，片語比對相鄰的字元；unicode61 會略過空白與標點，
+            # 比對結果可能跨越分隔字元（例如 'ns' 對上 'John Smith'），再以 LIKE 篩選原文
+            # 由逐字索引依 rowid 由大到小取出，找到足夠筆數即停止
+            source, row = f'{fts_table}_chars AS c JOIN {fts_table} AS s ON s.rowid = c.rowid', 'c'
+            condition = f'c.{fts_table}_chars MATCH :q AND {like}'
+            params['q'] = '"' + ' '.join(keyword).replace('"', '""') + '"'
+        else:
+            # 只有標點符號時逐字索引沒有可比對的詞
+            condition = like
+        sql = (f'SELECT {row}.rowid FROM {source} WHERE {condition} AND {row}.store_id = :store_id '
+               f'AND (:before < 0 OR {row}.rowid < :before) AND {row}.rowid != :exclude '
+               f'ORDER BY {row}.rowid DESC LIMIT :limit')
+        return [row[0] for row in db.session.execute(db.text(sql), params, bind_arguments={'mapper': model})]
+
+    pattern = f'%{_escape_like(keyword)}%'
+    query = db.session.query(model.id).filter(
+        model.store_id == store_id,
+        db.or_(*[col.ilike(pattern) for col in model_columns])
+    )
+    if before_id:
+        query = query.filter(model.id < before_id)
+    if exclude_id:
+        query = query.filter(model.id != exclude_id)
+    return [row[0] for row in query.order_by(model.id.desc()).limit(limit)]
+
+def _search_page_args():
+    keyword = (request.args.get('q') or '').strip()
+    before_id = request.args.get('before', type=int)
+    per_page = request.args.get('per_page', SEARCH_PAGE_SIZE, type=int)
+    per_page = max(1, min(per_page, SEARCH_MAX_PAGE_SIZE))
+    return keyword, before_id, per_page
+
+# 菜單快取
+# 每個 worker 在記憶體中依分店保存預先計算好的菜單 JSON，只有商品目錄版本改變時才重建；
+# 版本存在 SystemSetting 的 catalog_version@分店ID，最多每 MENU_CACHE_CHECK_INTERVAL 秒檢查一次，
+# 因此其他 worker 的商品異動最多延遲這段時間才會反映
+MENU_CACHE_CHECK_INTERVAL = 5
+_menu_cache = {}  # 分店ID -> {'version', 'payload', 'body', 'checked_at'}
+_menu_cache_lock = threading.Lock()
+
+def bump_catalog_version(store_id=None):
+    """遞增分店的商品目錄版本，需與商品異動在同一個交易中提交"""
+    if store_id is None:
+        store_id = current_store_id()
+    bump_version_counter(store_setting_key('catalog_version', store_id))
+    # 本 worker 下一次讀取菜單時立即重新檢查版本
+    if store_id in _menu_cache:
+        _menu_cache[store_id]['checked_at'] = 0.0
+
+def _build_menu_payload(version):
+    rows = db.session.query(
+        Product.id, Product.name, Product.price, Product.stock, Product.category, Product.image_hash
+    ).filter(Product.store_id == current_store_id()).order_by(Product.id).all()
+
+    categories = {}
+    for row in rows:
+        categories.setdefault(row.category or '其他', []).append({
+            'id': row.id,
+            'name': row.name,
+            'price': row.price,
+            'in_stock': (row.stock or 0) > 0,
+            'image': product_image_path(row.image_hash, 'sm', 'webp') if row.image_hash else None
+        })
+
+    return {
+        'version': version,
+        'category_counts': {name: len(items) for name, items in categories.items()},
+        'categories': [{'name': name, 'products': items} for name, items in categories.items()]
+    }
+
+def get_menu_payload():
+    """取得目前分店的菜單資料，回傳 (payload, 預先序列化的 JSON)"""
+    store_id = current_store_id()
+    now = time.monotonic()
+    entry = _menu_cache.get(store_id)
+    if entry is not None and now - entry['checked_at'] < MENU_CACHE_CHECK_INTERVAL:
+        return entry['payload'], entry['body']
+
+    with _menu_cache_lock:
+        entry = _menu_cache.get(store_id)
+        if entry is None or now - entry['checked_at'] >= MENU_CACHE_CHECK_INTERVAL:
+            version = read_version_counter(store_setting_key('catalog_version', store_id))
+            if entry is None or version != entry['version']:
+                payload = _build_menu_payload(version)
+                entry = {
+                    'version': version,
+                    'payload': payload,
+                    'body': json.dumps(dict(payload, success=True), ensure_ascii=False, separators=(',', ':'))
+                }
+                _menu_cache[store_id] = entry
+            entry['checked_at'] = now
+        return entry['payload'], entry['body']
+
+# 請求效能分析
+# 已登入的管理員在請求加上 X-Profile: 1 標頭或 ?_profile=1 參數時，以 cProfile 包住整個請求，
+# 並記錄每條 SQL 與耗時，報告寫入 instance/profiles，只保留最近 PROFILE_RING_SIZE 份。
+# 未帶標頭或參數的請求不讀取 session；SQL 監聽器在第一次分析時才註冊。
+# 同一個 worker 同時只能有一個 cProfile（Python 3.12 起會直接報錯），其他要求分析的請求照常處理但不分析
+PROFILE_RING_SIZE = 50
+PROFILE_MAX_QUERIES = 500
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_DIR = os.path.join(app.instance_path, 'profiles')
+_PROFILE_NAME_RE = re.compile(r'^[0-9]+-[0-9]+\.json$')
+_profile_local = threading.local()
+_profile_lock = threading.Lock()
+_profile_listeners_installed = False
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_profile_local, 'queries', None) is not None:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = getattr(_profile_local, 'queries', None)
+    starts = conn.info.get('profile_query_start')
+    if queries is None or not starts:
+        return
+    elapsed = (time.perf_counter() - starts.pop()) * 1000
+    if len(queries) < PROFILE_MAX_QUERIES:
+        queries.append({'statement': statement, 'duration_ms': round(elapsed, 3)})
+
+def _install_profile_listeners():
+    global _profile_listeners_installed
+    if not _profile_listeners_installed:
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+        _profile_listeners_installed = True
+
+def _profile_requested():
+    if request.headers.get('X-Profile') != '1' and request.args.get('_profile') != '1':
+        return False
+    return bool(session.get('admin_logged_in'))
+
+@app.before_request
+def start_profiling():
+    if request.endpoint == 'static' or not _profile_requested():
+        return
+    if not _profile_lock.acquire(blocking=False):
+        g.profile_skipped = True
+        return
+    _install_profile_listeners()
+    _profile_local.queries = []
+    _profile_local.started_at = time.perf_counter()
+    _profile_local.profiler = cProfile.Profile()
+    _profile_local.profiler.enable()
+
+def _finish_profiling(status_code):
+    profiler = getattr(_profile_local, 'profiler', None)
+    if profiler is None:
+        return None
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+    duration = (time.perf_counter() - _profile_local.started_at) * 1000
+    queries = _profile_local.queries
+    _profile_local.profiler = None
+    _profile_local.queries = None
+
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+
+    name = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{os.getpid()}.json"
+    report = {
+        'name': name,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status_code': status_code,
+        'duration_ms': round(duration, 3),
+        'sql_count': len(queries),
+        'sql_duration_ms': round(sum(q['duration_ms'] for q in queries), 3),
+        'queries': queries,
+        'created_at': datetime.utcnow().isoformat(),
+        'stats': stream.getvalue()
+    }
+    save_profile_report(report)
+    return name
+
+def save_profile_report(report):
+    """寫入分析報告並刪除超出 PROFILE_RING_SIZE 的舊報告"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, report['name']), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+    for old_name in list_profile_reports()[PROFILE_RING_SIZE:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old_name))
+        except OSError:
+            pass
+
+def list_profile_reports():
+    """回傳報告檔名，由新到舊排序"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted((name for name in os.listdir(PROFILE_DIR) if _PROFILE_NAME_RE.match(name)), reverse=True)
+
+def load_profile_report(name):
+    if not _PROFILE_NAME_RE.match(name):
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, name), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@app.after_request
+def stop_profiling(response):
+    name = _finish_profiling(response.status_code)
+    if name:
+        response.headers['X-Profile-Id'] = name
+    elif g.get('profile_skipped'):
+        response.headers['X-Profile-Skipped'] = 'busy'
+    return response
+
+@app.teardown_request
+def abort_profiling(exc):
+    # 發生未處理例外時 after_request 不會執行，在此收尾
+    if getattr(_profile_local, 'profiler', None) is not None:
+        _finish_profiling(500)
+
+# 限流與負載保護
+# 每個用戶端在每個路由各有一個 token bucket，超過時回傳 429；
+# 另外統計本 worker 進行中的請求數，超過門檻時公開路由立即回傳 503，
+# 商家端（已登入的管理員、收銀員）保留 STAFF_RESERVED_IN_FLIGHT 個名額並使用獨立的限流額度；
+# 是否為商家端只看 session 的登入狀態，未登入的請求即使存取 /admin 路徑也以公開額度計算。
+# 進行中的請求數要能超過 1，worker 必須是多執行緒（gunicorn.conf.py 使用 gthread，
+# 且 threads 大於 MAX_IN_FLIGHT），單執行緒的 sync worker 下負載保護不會觸發。
+# 用戶端以 remote_addr 區分，經過反向代理時需設定 PROXY_FIX_X_FOR。
+# 設定 RATE_LIMIT_STORAGE_URL=redis://... 時，各 worker 共用 Redis 中的 bucket
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+RATE_LIMIT_STORAGE_URL = os.environ.get('RATE_LIMIT_STORAGE_URL')
+# 端點 -> (最大突發數, 每秒補充數)
+RATE_LIMITS = {
+    'add_to_cart': (30, 1.0),
+    'update_cart': (30, 1.0),
+    'prepare_order': (10, 0.2),
+    'submit_order': (5, 0.1),
+    'order_status': (30, 0.5),
+    'admin_login_api': (5, 0.1),
+    'cashier_login_api': (5, 0.1),
+}
+PUBLIC_DEFAULT_RATE_LIMIT = (60, 5.0)
+STAFF_RATE_LIMIT = (120, 10.0)
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 32))
+STAFF_RESERVED_IN_FLIGHT = int(os.environ.get('STAFF_RESERVED_IN_FLIGHT', 8))
+SHED_RETRY_AFTER = 2
+
+class MemoryRateLimitStore:
+    """單一 worker 內的 token bucket，最多保留 max_keys 個，超過時淘汰最久未使用的"""
+
+    def __init__(self, max_keys=10000):
+        self._buckets = OrderedDict()  # key -> (剩餘 token, 更新時間)
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def consume(self, key, capacity, rate):
+        """取用一個 token，回傳 (是否允許, 建議等待秒數)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+            if allowed:
+                return True, 0
+            return False, (1 - tokens) / rate
+
+class RedisRateLimitStore:
+    """多個 worker 共用的 token bucket，以 Lua 腳本在 Redis 內原子地更新"""
+
+    _SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+    def __init__(self, url):
+        import redis  # 選用套件，只有設定 RATE_LIMIT_STORAGE_URL 時才需要
+        self._client = redis.Redis.from_url(url, socket_timeout=0.2)
+        self._script = self._client.register_script(self._SCRIPT)
+
+    def consume(self, key, capacity, rate):
+        try:
+            allowed, wait = self._script(keys=[key], args=[capacity, rate])
+        except Exception as e:
+            # Redis 無法使用時放行，避免限流本身讓整個服務停擺
+            app.logger.warning('限流儲存無法使用：%s', e)
+            return True, 0
+        return bool(allowed), float(wait)
+
+def _create_rate_limit_store():
+    if RATE_LIMIT_STORAGE_URL and RATE_LIMIT_STORAGE_URL.startswith(('redis://', 'rediss://')):
+        return RedisRateLimitStore(RATE_LIMIT_STORAGE_URL)
+    return MemoryRateLimitStore()
+
+rate_limit_store = _create_rate_limit_store()
+_in_flight = {'count': 0}
+_in_flight_lock = threading.Lock()
+
+def _is_staff_request():
+    return bool(session.get('admin_logged_in') or session.get('cashier_logged_in'))
+
+def _client_key():
+    if session.get('admin_logged_in'):
+        return f"admin:{session.get('admin_id')}"
+    if session.get('cashier_logged_in'):
+        return f"cashier:{session.get('cashier_id')}"
+    # 不讀取 X-Forwarded-For，經過反向代理時由 ProxyFix（PROXY_FIX_X_FOR）改寫 remote_addr
+    return request.remote_addr or '-'
+
+def _reject(status_code, message, retry_after):
+    if request.path.startswith('/api/'):
+        response = jsonify({'success': False, 'message': message})
+    else:
+        response = app.response_class(message, mimetype='text/plain')
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+@app.before_request
+def guard_request():
+    if not RATE_LIMIT_ENABLED or request.endpoint in (None, 'static', 'product_image'):
+        return
+
+    staff = _is_staff_request()
+    limit = MAX_IN_FLIGHT if staff else MAX_IN_FLIGHT - STAFF_RESERVED_IN_FLIGHT
+    with _in_flight_lock:
+        if _in_flight['count'] >= limit:
+            return _reject(503, '系統忙碌中，請稍後再試', SHED_RETRY_AFTER)
+        _in_flight['count'] += 1
+    request.environ['in_flight_counted'] = True
+
+    if staff:
+        capacity, rate = STAFF_RATE_LIMIT
+        key = f'rl:staff:{_client_key()}'
+    else:
+        capacity, rate = RATE_LIMITS.get(request.endpoint, PUBLIC_DEFAULT_RATE_LIMIT)
+        key = f'rl:{request.endpoint}:{_client_key()}'
+    allowed, wait = rate_limit_store.consume(key, capacity, rate)
+    if not allowed:
+        return _reject(429, '請求過於頻繁，請稍後再試', wait)
+
+@app.teardown_request
+def release_in_flight(exc):
+    if request.environ.pop('in_flight_counted', False):
+        with _in_flight_lock:
+            _in_flight['count'] -= 1
+
+# 銷售彙總
+# 過去日期的銷售數字依分店存於 DailySales，報表只需即時計算今天；
+# 修改或刪除舊訂單時把該日彙總標為失效（computed_at 為空），直到背景任務重新計算前改為即時計算。
+# 背景任務只計算沒有有效彙總的日期，寫入時比對 invalidated_at，計算期間又被異動的日期留待下次重算
+DAILY_SALES_RECOMPUTE_DAYS = 35
+
+def accumulate_product_sales(product_sales, items):
+    """將訂單項目累加到 {商品ID: {name, quantity, revenue}}"""
+    for item in items:
+        product_id = str(item['id'])
+        quantity = item['quantity']
+        if product_id in product_sales:
+            product_sales[product_id]['quantity'] += quantity
+            product_sales[product_id]['revenue'] += item['price'] * quantity
+        else:
+            product_sales[product_id] = {
+                'name': item['name'],
+                'quantity': quantity,
+                'revenue': item['price'] * quantity
+            }
+
+def compute_daily_sales(day):
+    """即時計算目前分店某一天（UTC）的訂單數、營收與商品銷量"""
+    start = datetime.combine(day, datetime.min.time())
+    rows = db.session.query(Order.total_price, Order.order_items).filter(
+        Order.store_id == current_store_id(),
+        Order.created_at >= start,
+        Order.created_at < start + timedelta(days=1)
+    ).all()
+
+    product_sales = {}
+    for row in rows:
+        try:
+            accumulate_product_sales(product_sales, json.loads(row.order_items))
+        except:
+            continue
+
+    return {
+        'order_count': len(rows),
+        'revenue': sum(row.total_price for row in rows),
+        'product_sales': product_sales
+    }
+
+def get_daily_sales(days):
+    """取得多天的銷售彙總，今天與尚未彙總的日期即時計算"""
+    today = datetime.utcnow().date()
+    stored = {
+        row.date: row for row in store_query(DailySales).filter(
+            DailySales.date.in_([d for d in days if d < today]),
+            DailySales.computed_at.isnot(None)
+        )
+    }
+
+    result = {}
+    for day in days:
+        row = stored.get(day)
+        if row is not None:
+            result[day] = {
+                'order_count': row.order_count,
+                'revenue': row.revenue,
+                'product_sales': json.loads(row.product_sales)
+            }
+        else:
+            result[day] = compute_daily_sales(day)
+    return result
+
+def invalidate_daily_sales(created_at):
+    """舊訂單異動時把該日彙總標為失效，需與訂單異動在同一個交易中提交"""
+    if created_at and created_at.date() < datetime.utcnow().date():
+        store_query(DailySales).filter(DailySales.date == created_at.date()).update(
+            {'computed_at': None, 'invalidated_at': datetime.utcnow()}, synchronize_session=False)
+
+def recompute_daily_sales(days=DAILY_SALES_RECOMPUTE_DAYS):
+    """計算目前分店過去幾天中沒有有效彙總的日期，回傳寫入的天數"""
+    store_id = current_store_id()
+    today = datetime.utcnow().date()
+    all_days = [today - timedelta(days=offset) for offset in range(1, days + 1)]
+    valid = {row.date for row in store_query(DailySales).with_entities(DailySales.date).filter(
+        DailySales.date.in_(all_days), DailySales.computed_at.isnot(None))}
+
+    written = 0
+    for day in all_days:
+        if day in valid:
+            continue
+        row = db.session.get(DailySales, (store_id, day))
+        if row is None:
+            # 先寫入失效的列再計算，計算期間的訂單異動才有列可以標記
+            row = DailySales(store_id=store_id, date=day, computed_at=None, invalidated_at=datetime.utcnow())
+            db.session.add(row)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                continue
+        invalidated_at = row.invalidated_at
+
+        stats = compute_daily_sales(day)
+        updated = store_query(DailySales).filter(
+            DailySales.date == day,
+            DailySales.invalidated_at.is_(None) if invalidated_at is None
+            else DailySales.invalidated_at == invalidated_at
+        ).update({
+            'order_count': stats['order_count'],
+            'revenue': stats['revenue'],
+            'product_sales': json.dumps(stats['product_sales']),
+            'computed_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        written += updated
+    return written
+
+# 報表快取
+# 營業結束時多人同時開啟總覽或報表，同一時間相同的統計只由第一個請求計算，其他請求等待並共用結果；
+# 結果再保留數秒到一分鐘，各頁面的秒數由 report_cache_ttl_<頁面> 設置決定（可依分店設定，0 為不保留）。
+# 快取在各 worker 的記憶體中，訂單異動只清除本 worker 的快取，其他 worker 最多延遲一個 TTL
+# 合併只發生在同一 worker 的執行緒之間，需以多執行緒 worker 部署（gunicorn.conf.py 的 gthread），
+# N 個 worker 時同一份統計最多同時計算 N 次
+REPORT_CACHE_MAX_ENTRIES = 256
+REPORT_COMPUTE_TIMEOUT = 30
+
+class ReportCache:
+    """有筆數上限的 LRU + TTL 快取，並合併同時進行的相同計算（single-flight）"""
+
+    def __init__(self, max_entries=REPORT_CACHE_MAX_ENTRIES):
+        self._entries = OrderedDict()  # key -> (到期時間, 結果)
+        self._in_flight = {}  # key -> {'event', 'value', 'error'}
+        self._generation = 0  # 每次清除快取時遞增，清除前開始的計算結果不寫入快取
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+
+    def get_or_compute(self, key, ttl, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = {'event': threading.Event(), 'value': None, 'error': None}
+                self._in_flight[key] = flight
+                generation = self._generation
+            else:
+                generation = None
+
+        if generation is None:
+            # 等待進行中的計算；逾時則自行計算，不寫入快取
+            if not flight['event'].wait(REPORT_COMPUTE_TIMEOUT):
+                return compute()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['value']
+
+        completed = False
+        try:
+            flight['value'] = compute()
+            completed = True
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                if completed and ttl > 0 and generation == self._generation:
+                    self._entries[key] = (time.monotonic() + ttl, flight['value'])
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self._max_entries:
+                        self._entries.popitem(last=False)
+            flight['event'].set()
+        return flight['value']
+
+    def invalidate(self, predicate=None):
+        with self._lock:
+            self._generation += 1
+            if predicate is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if predicate(key)]:
+                    del self._entries[key]
+
+_report_cache = ReportCache()
+
+def cached_report(view, compute, key=()):
+    """依（頁面, 分店, *key）快取 compute 的結果，compute 只能回傳不含 ORM 物件的資料"""
+    store_id = current_store_id()
+    ttl = max(0, get_setting(f'report_cache_ttl_{view}', store_id))
+    return _report_cache.get_or_compute((view, store_id) + tuple(key), ttl, compute)
+
+def invalidate_reports(store_id=None):
+    """訂單異動提交後呼叫，清除該分店的報表快取"""
+    store_id = current_store_id() if store_id is None else store_id
+    _report_cache.invalidate(lambda key: key[1] == store_id)
+
+# 需求預測
+# 以 SQL 展開近期訂單的 order_items，取得（訂單, 小時, 商品, 數量）後交給 NumPy 彙總成「小時 × 商品」矩陣，
+# 再依當地時間的星期與小時（7 × 24 個時段）計算加權平均，近期的週次權重較高（半衰期 FORECAST_HALF_LIFE_WEEKS）。
+# 預測某一天時直接取該星期的 24 個時段。
+# 展開 JSON 是最耗時的部分，啟動時在 master 展開一次（warm_caches），worker 以 copy-on-write 共用這份 base 陣列，
+# 之後不再修改它：新訂單與重新展開的訂單放在各 worker 自己的小型 tail，被取代的訂單編號記在 masked，
+# tail 超過 FORECAST_TAIL_MAX_ROWS 筆才合併成新的 base。修改或刪除訂單時寫入一筆 DemandRowsPatch，
+# 各 worker 讀取預測時只重新展開這些訂單；資料超過 FORECAST_ROWS_MAX_AGE 秒時在背景執行緒完整重載。
+# 查詢資料庫時不持有 _demand_rows_lock，只在替換快取時短暫持有。
+# 計算結果以資料世代（有新資料就遞增）與資料區間的結束時間放進報表快取，不必每次查詢訂單數
+FORECAST_WINDOW_DAYS = 365
+FORECAST_HALF_LIFE_WEEKS = 8
+FORECAST_MAX_DAYS_AHEAD = 14
+FORECAST_ROWS_MAX_AGE = 3600
+FORECAST_TAIL_MAX_ROWS = 50000
+FORECAST_PATCH_RETENTION_DAYS = 2
+# 班別名稱、開始小時、結束小時（當地時間，不含結束小時）
+FORECAST_SHIFTS = (('早班', 0, 14), ('晚班', 14, 24))
+# 分店ID -> {'base', 'tail', 'masked', 'since', 'max_order_id', 'patch_id', 'generation', 'loaded_at'}
+_demand_rows = {}
+_demand_rows_lock = threading.Lock()
+_demand_rows_reloading = set()  # 正在背景重載的分店ID
+_EMPTY_DEMAND_ROWS = np.empty((0, 4))
+
+_SQLITE_ORDER_ITEM_ROWS_SQL = """
+    SELECT o.id,
+           CAST(strftime('%s', o.created_at) AS INTEGER) / 3600,
+           CAST(json_extract(item.value, '$.id') AS INTEGER),
+           CAST(json_extract(item.value, '$.quantity') AS REAL)
+    FROM "order" AS o,
+         json_each(CASE WHEN json_valid(o.order_items) THEN o.order_items ELSE '[]' END) AS item
+    WHERE o.store_id = :store_id AND o.created_at >= :since AND o.id > :after_id
+      AND json_type(item.value, '$.id') = 'integer' AND json_type(item.value, '$.quantity') IN ('integer', 'real')
+"""
+
+# 格式錯誤或不是陣列的 order_items 視為沒有項目（safe_jsonb 由 _POSTGRES_ORDER_SEARCH_DDL 建立）
+_POSTGRES_ORDER_ITEM_ROWS_SQL = """
+    SELECT o.id,
+           FLOOR(EXTRACT(EPOCH FROM o.created_at) / 3600)::bigint,
+           (item ->> 'id')::numeric::bigint,
+           (item ->> 'quantity')::double precision
+    FROM "order" AS o
+         CROSS JOIN LATERAL jsonb_array_elements(
+             CASE WHEN jsonb_typeof(safe_jsonb(o.order_items)) = 'array'
+                  THEN safe_jsonb(o.order_items) ELSE '[]'::jsonb END) AS item
+    WHERE o.store_id = :store_id AND o.created_at >= :since AND o.id > :after_id
+      AND jsonb_typeof(item -> 'id') = 'number' AND jsonb_typeof(item -> 'quantity') = 'number'
+"""
+
+def load_order_item_rows(connection, store_id, since, after_id=0, order_ids=None):
+    """回傳 (n, 4) 陣列：訂單編號、自 1970 年起算的 UTC 小時、商品編號、數量；指定 order_ids 時只展開這些訂單"""
+    sql = _POSTGRES_ORDER_ITEM_ROWS_SQL if connection.dialect.name == 'postgresql' else _SQLITE_ORDER_ITEM_ROWS_SQL
+    params = {'store_id': store_id, 'since': since, 'after_id': after_id}
+    statement = db.text(sql)
+    if order_ids is not None:
+        statement = db.text(sql + ' AND o.id IN :order_ids').bindparams(db.bindparam('order_ids', expanding=True))
+        params['order_ids'] = list(order_ids)
+    rows = connection.execute(statement, params).all()
+    # 逐列建立陣列比 np.array(rows) 快得多
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64, count=len(rows) * 4).reshape(-1, 4)
+
+def forecast_window(now):
+    """預測使用的資料區間：過去 FORECAST_WINDOW_DAYS 天到上一個整點，回傳 (since, until)"""
+    until = now.replace(minute=0, second=0, microsecond=0)
+    return until - timedelta(days=FORECAST_WINDOW_DAYS), until
+
+def record_demand_rows_patch(order_id, store_id=None):
+    """訂單項目被修改或刪除時呼叫，需與訂單異動在同一個交易中提交"""
+    db.session.add(DemandRowsPatch(store_id=current_store_id() if store_id is None else store_id, order_id=order_id))
+
+def _read_demand_rows_patches(store_id, after_patch_id):
+    return db.session.query(DemandRowsPatch.id, DemandRowsPatch.order_id).filter(
+        DemandRowsPatch.store_id == store_id, DemandRowsPatch.id > after_patch_id
+    ).order_by(DemandRowsPatch.id).all()
+
+def combine_demand_rows(entry):
+    """base 去掉被取代的訂單後接上 tail；沒有異動時直接回傳共用的 base"""
+    base = entry['base']
+    if entry['masked']:
+        base = base[~np.isin(base[:, 0], list(entry['masked']))]
+    if not len(entry['tail']):
+        return base
+    return np.concatenate([base, entry['tail']])
+
+def load_demand_rows(store_id, since, generation=0):
+    """完整展開分店自 since 起的訂單項目並存入快取"""
+    with store_context(store_id):
+        # 先記下已處理到的異動，展開期間的新異動留給下一次讀取
+        patch_id = db.session.query(db.func.max(DemandRowsPatch.id)).filter(
+            DemandRowsPatch.store_id == store_id).scalar() or 0
+        connection = db.session.connection(bind_arguments={'mapper': Order})
+        base = load_order_item_rows(connection, store_id, since)
+    entry = {'base': base, 'tail': _EMPTY_DEMAND_ROWS, 'masked': frozenset(), 'since': since,
+             'max_order_id': int(base[:, 0].max()) if len(base) else 0, 'patch_id': patch_id,
+             'generation': generation + 1, 'loaded_at': time.monotonic()}
+    with _demand_rows_lock:
+        current = _demand_rows.get(store_id)
+        if current is not None:
+            entry['generation'] = max(entry['generation'], current['generation'] + 1)
+        _demand_rows[store_id] = entry
+    return entry
+
+def _reload_demand_rows(store_id, since):
+    try:
+        with app.app_context():
+            load_demand_rows(store_id, since)
+    except Exception:
+        app.logger.exception('分店 %s 預測資料重載失敗', store_id)
+    finally:
+        with _demand_rows_lock:
+            _demand_rows_reloading.discard(store_id)
+
+def refresh_demand_rows(since):
+    """展開目前分店的新訂單與有異動的訂單，回傳更新後的快取項目"""
+    store_id = current_store_id()
+    with _demand_rows_lock:
+        entry = _demand_rows.get(store_id)
+    if entry is None:
+        # 啟動後才建立的分店沒有預熱資料
+        entry = load_demand_rows(store_id, since)
+
+    with _demand_rows_lock:
+        if time.monotonic() - entry['loaded_at'] > FORECAST_ROWS_MAX_AGE and store_id not in _demand_rows_reloading:
+            _demand_rows_reloading.add(store_id)
+            threading.Thread(target=_reload_demand_rows, args=(store_id, since),
+                             name='demand-rows', daemon=True).start()
+
+    # 查詢時不持有鎖
+    patches = _read_demand_rows_patches(store_id, entry['patch_id'])
+    patched_ids = {order_id for _, order_id in patches}
+    connection = db.session.connection(bind_arguments={'mapper': Order})
+    new_rows = load_order_item_rows(connection, store_id, entry['since'], entry['max_order_id'])
+    if not patches and not len(new_rows):
+        return entry
+    if patched_ids:
+        new_rows = new_rows[~np.isin(new_rows[:, 0], list(patched_ids))]
+        patched_rows = load_order_item_rows(connection, store_id, entry['since'], order_ids=patched_ids)
+        tail = entry['tail'][~np.isin(entry['tail'][:, 0], list(patched_ids))]
+    else:
+        patched_rows, tail = _EMPTY_DEMAND_ROWS, entry['tail']
+    updated = dict(entry,
+                   tail=np.concatenate([tail, patched_rows, new_rows]),
+                   masked=entry['masked'] | patched_ids,
+                   max_order_id=max([entry['max_order_id']] + ([int(new_rows[:, 0].max())] if len(new_rows) else [])),
+                   patch_id=patches[-1][0] if patches else entry['patch_id'],
+                   generation=entry['generation'] + 1)
+    if len(updated['tail']) > FORECAST_TAIL_MAX_ROWS:
+        # 合併後本 worker 不再共用 master 的 base
+        updated.update(base=combine_demand_rows(updated), tail=_EMPTY_DEMAND_ROWS, masked=frozenset())
+
+    with _demand_rows_lock:
+        # 其他執行緒已先更新（或背景重載已完成）時，以目前的快取為準，遺漏的部分下次讀取時補上
+        if _demand_rows.get(store_id) is entry:
+            _demand_rows[store_id] = updated
+        return _demand_rows[store_id]
+
+def get_order_item_rows(since):
+    """目前分店自 since 起的訂單項目，只展開上次載入之後的新訂單與有異動的訂單"""
+    return combine_demand_rows(refresh_demand_rows(since))
+
+def warm_demand_rows():
+    """預先展開各分店的訂單項目（需在 app context 內呼叫），fork 後的 worker 直接共用"""
+    since, _ = forecast_window(datetime.utcnow())
+    for store in get_stores():
+        load_demand_rows(store['id'], since)
+
+def prune_demand_rows_patches():
+    """刪除已超過保留天數的訂單異動紀錄，各 worker 早已完整重載"""
+    cutoff = datetime.utcnow() - timedelta(days=FORECAST_PATCH_RETENTION_DAYS)
+    count = DemandRowsPatch.query.filter(DemandRowsPatch.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def build_demand_matrix(rows, first_hour, hour_count):
+    """把 load_order_item_rows 的結果彙總成 (小時數, 商品數) 矩陣，回傳 (矩陣, 商品編號陣列)"""
+    hours = rows[:, 1].astype(np.int64) - first_hour
+    valid = (hours >= 0) & (hours < hour_count) & (rows[:, 3] > 0)
+    hours, product_ids, quantities = hours[valid], rows[valid, 2].astype(np.int64), rows[valid, 3]
+    columns, product_index = np.unique(product_ids, return_inverse=True)
+    matrix = np.bincount(hours * len(columns) + product_index, weights=quantities,
+                         minlength=hour_count * len(columns)).reshape(hour_count, len(columns))
+    return matrix, columns
+
+def seasonal_hourly_averages(matrix, first_hour, utc_offset_hours):
+    """依當地星期與小時計算 (168, 商品數) 的加權平均，星期一 0 時為第 0 列"""
+    hour_count = matrix.shape[0]
+    local_hours = np.arange(first_hour, first_hour + hour_count) + utc_offset_hours
+    # 1970-01-01 是星期四
+    slots = ((local_hours // 24 + 3) % 7) * 24 + local_hours % 24
+    weeks_ago = (hour_count - 1 - np.arange(hour_count)) / (24 * 7)
+    weights = 0.5 ** (weeks_ago / FORECAST_HALF_LIFE_WEEKS)
+
+    totals = np.zeros((7 * 24, matrix.shape[1]))
+    np.add.at(totals, slots, matrix * weights[:, None])
+    weight_sums = np.bincount(slots, weights=weights, minlength=7 * 24)
+    return np.divide(totals, weight_sums[:, None], out=np.zeros_like(totals), where=weight_sums[:, None] > 0)
+
+def compute_demand_profile():
+    """目前分店過去 FORECAST_WINDOW_DAYS 天（到上一個整點為止）的季節平均"""
+    now = datetime.utcnow()
+    since, until = forecast_window(now)
+    first_hour = int((since - datetime(1970, 1, 1)).total_seconds()) // 3600
+    last_hour = int((until - datetime(1970, 1, 1)).total_seconds()) // 3600
+
+    rows = get_order_item_rows(since)
+    in_window = rows[(rows[:, 1] >= first_hour) & (rows[:, 1] < last_hour)]
+    # 從第一筆訂單當天開始計算，開店前的時段不算成零銷量
+    if len(in_window):
+        first_hour = max(first_hour, int(in_window[:, 1].min()) // 24 * 24)
+    matrix, product_ids = build_demand_matrix(in_window, first_hour, last_hour - first_hour)
+    utc_offset_hours = int(tz.utcoffset(now).total_seconds()) // 3600
+    return {
+        'product_ids': product_ids.tolist(),
+        'averages': seasonal_hourly_averages(matrix, first_hour, utc_offset_hours),
+        'order_item_count': len(in_window),
+        'computed_at': now
+    }
+
+def get_demand_profile():
+    # 資料世代只在有新訂單或異動時遞增，兩個查詢都只讀取編號大於上次位置的資料
+    since, until = forecast_window(datetime.utcnow())
+    entry = refresh_demand_rows(since)
+    return cached_report('forecast', compute_demand_profile, key=(until, entry['generation']))
+
+def forecast_demand(day):
+    """預測目前分店某一天（當地日期）各商品每小時的數量，回傳 (24, 商品數) 矩陣、商品編號與計算資訊"""
+    profile = get_demand_profile()
+    start = day.weekday() * 24
+    return profile['averages'][start:start + 24], profile['product_ids'], profile
+
+@app.cli.command('bench-forecast')
+@click.option('--orders-per-day', default=300, show_default=True, help='每天的測試訂單數')
+@click.option('--products', 'product_count', default=40, show_default=True, help='商品數')
+def bench_forecast_command(orders_per_day, product_count):
+    """在暫存的 SQLite 資料庫建立一年份訂單，量測展開訂單項目與建立需求矩陣的時間"""
+    rng = np.random.default_rng(0)
+    order_count = orders_per_day * FORECAST_WINDOW_DAYS
+    since, until = forecast_window(datetime.utcnow())
+    offsets = np.sort(rng.integers(0, FORECAST_WINDOW_DAYS * 86400, order_count))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        Order.__table__.create(engine)
+        with engine.begin() as conn:
+            for offset in range(0, order_count, 10000):
+                batch = []
+                for n in range(offset, min(offset + 10000, order_count)):
+                    items = [{'id': int(product_id), 'name': f'測試商品{product_id}', 'price': 100,
+                              'quantity': int(rng.integers(1, 4))}
+                             for product_id in rng.choice(product_count, size=int(rng.integers(1, 5)), replace=False)]
+                    batch.append({'customer_name': f'顧客{n}', 'order_items': json.dumps(items), 'total_price': 100,
+                                  'created_at': since + timedelta(seconds=int(offsets[n])), 'store_id': 1})
+                conn.execute(Order.__table__.insert(), batch)
+        click.echo(f'已建立 {order_count} 筆訂單（{FORECAST_WINDOW_DAYS} 天）')
+
+        first_hour = int((since - datetime(1970, 1, 1)).total_seconds()) // 3600
+        with engine.connect() as conn:
+            t0 = time.perf_counter()
+            rows = load_order_item_rows(conn, 1, since)
+            t1 = time.perf_counter()
+            matrix, product_ids = build_demand_matrix(rows, first_hour, FORECAST_WINDOW_DAYS * 24)
+            t2 = time.perf_counter()
+            seasonal_hourly_averages(matrix, first_hour, 8)
+            t3 = time.perf_counter()
+            # 新增一筆訂單後只需展開新訂單
+            load_order_item_rows(conn, 1, since, int(rows[:, 0].max()) - 1)
+            t4 = time.perf_counter()
+        click.echo(f'完整展開 {len(rows)} 筆訂單項目 {(t1 - t0) * 1000:.1f} ms')
+        click.echo(f'建立 {matrix.shape[0]} × {matrix.shape[1]} 矩陣 {(t2 - t1) * 1000:.1f} ms，'
+              f'季節平均 {(t3 - t2) * 1000:.1f} ms')
+        click.echo(f'增量展開新訂單 {(t4 - t3) * 1000:.1f} ms')
+        engine.dispose()
+
+# 背景任務排程
+# 每個 worker 各有一個排程執行緒，定期找出到期的任務並以條件式 UPDATE 搶佔，
+# 搶到的 worker 才交給執行緒池執行，因此多個 gunicorn worker 下每次排程只會執行一次。
+# 執行中的 worker 異常結束時，租約 JOB_LEASE_SECONDS 過後其他 worker 可接手
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') != '0'
+SCHEDULER_TICK_SECONDS = 30
+SCHEDULER_MAX_WORKERS = 2
+JOB_LEASE_SECONDS = 1800
+JOBS = {}
+_scheduler_state = {'thread': None, 'executor': None}
+
+def scheduled_job(name, interval_seconds):
+    """註冊背景任務"""
+    def decorator(func):
+        JOBS[name] = {'func': func, 'interval_seconds': interval_seconds}
+        return func
+    return decorator
+
+@scheduled_job('recompute_daily_sales', 600)
+def recompute_daily_sales_job():
+    for store in get_stores():
+        with store_context(store['id']):
+            if recompute_daily_sales():
+                invalidate_reports()
+
+@scheduled_job('prune_operation_logs', 86400)
+def prune_operation_logs_job():
+    prune_operation_logs()
+
+@scheduled_job('prune_demand_rows_patches', 86400)
+def prune_demand_rows_patches_job():
+    prune_demand_rows_patches()
+
+@scheduled_job('analyze_database', 86400)
+def analyze_database_job():
+    # SQLite 的 VACUUM 會鎖住整個資料庫，只更新查詢統計；PostgreSQL 的 VACUUM 不阻擋讀寫
+    engines = [db.engine] + [get_store_engine(store['id']) for store in get_stores()]
+    seen = set()
+    for engine in engines:
+        if engine is None or engine.url in seen:
+            continue
+        seen.add(engine.url)
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if engine.dialect.name == 'postgresql':
+                conn.execute(db.text('VACUUM ANALYZE'))
+            else:
+                conn.execute(db.text('ANALYZE'))
+                conn.execute(db.text('PRAGMA optimize'))
+
+def sync_scheduled_jobs():
+    """確保每個已註冊的任務都有排程資料列（需在 app context 內呼叫）"""
+    existing = {job.name: job for job in ScheduledJob.query.all()}
+    for name, spec in JOBS.items():
+        job = existing.get(name)
+        if job is None:
+            db.session.add(ScheduledJob(name=name, interval_seconds=spec['interval_seconds'],
+                                        next_run_at=datetime.utcnow()))
+        elif job.interval_seconds != spec['interval_seconds']:
+            job.interval_seconds = spec['interval_seconds']
+    db.session.commit()
+
+def _claim_job(name, interval_seconds, worker_id):
+    now = datetime.utcnow()
+    claimed = ScheduledJob.query.filter(
+        ScheduledJob.name == name,
+        ScheduledJob.next_run_at <= now,
+        db.or_(ScheduledJob.locked_until.is_(None), ScheduledJob.locked_until < now)
+    ).update({
+        ScheduledJob.locked_until: now + timedelta(seconds=JOB_LEASE_SECONDS),
+        ScheduledJob.locked_by: worker_id,
+        ScheduledJob.last_started_at: now,
+        ScheduledJob.next_run_at: now + timedelta(seconds=interval_seconds)
+    }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+def run_job(name):
+    """執行任務並記錄耗時與結果"""
+    with app.app_context():
+        started = time.perf_counter()
+        status, error = '成功', None
+        try:
+            JOBS[name]['func']()
+        except Exception as e:
+            db.session.rollback()
+            status, error = '失敗', f'{type(e).__name__}: {e}'[:1000]
+            app.logger.exception('背景任務 %s 執行失敗', name)
+        duration = (time.perf_counter() - started) * 1000
+
+        ScheduledJob.query.filter_by(name=name).update({
+            ScheduledJob.locked_until: None,
+            ScheduledJob.locked_by: None,
+            ScheduledJob.last_finished_at: datetime.utcnow(),
+            ScheduledJob.last_duration_ms: duration,
+            ScheduledJob.last_status: status,
+            ScheduledJob.last_error: error,
+            ScheduledJob.run_count: ScheduledJob.run_count + 1,
+            ScheduledJob.failure_count: ScheduledJob.failure_count + (1 if error else 0),
+            ScheduledJob.total_duration_ms: ScheduledJob.total_duration_ms + duration
+        }, synchronize_session=False)
+        db.session.commit()
+
+def _scheduler_loop(worker_id):
+    while True:
+        try:
+            with app.app_context():
+                now = datetime.utcnow()
+                due = db.session.query(ScheduledJob.name, ScheduledJob.interval_seconds).filter(
+                    ScheduledJob.next_run_at <= now,
+                    db.or_(ScheduledJob.locked_until.is_(None), ScheduledJob.locked_until < now)
+                ).all()
+                for name, interval_seconds in due:
+                    if name in JOBS and _claim_job(name, interval_seconds, worker_id):
+                        _scheduler_state['executor'].submit(run_job, name)
+        except Exception:
+            app.logger.exception('背景任務排程失敗')
+        time.sleep(SCHEDULER_TICK_SECONDS)
+
+def start_scheduler():
+    """啟動本 worker 的排程執行緒（執行緒無法跨 fork 保留，需在 fork 後呼叫）"""
+    if not SCHEDULER_ENABLED or _scheduler_state['thread'] is not None:
+        return
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    _scheduler_state['executor'] = ThreadPoolExecutor(max_workers=SCHEDULER_MAX_WORKERS,
+                                                      thread_name_prefix='job')
+    thread = threading.Thread(target=_scheduler_loop, args=(worker_id,), name='scheduler', daemon=True)
+    _scheduler_state['thread'] = thread
+    thread.start()
+
+# 商品圖片
+# 管理員上傳或提供網址的圖片存於 PRODUCT_IMAGE_DIR，並產生數種寬度的 WebP/JPEG 縮圖，
+# 檔名含內容雜湊，可設定為永久快取；尚未快取的遠端圖片由背景任務下載，
+# 下載失敗時重試間隔依次加倍，連續失敗 PRODUCT_IMAGE_MAX_FAILURES 次後不再重試，直到圖片網址變更
+PRODUCT_IMAGE_SIZES = {'sm': 160, 'md': 320, 'lg': 640}
+PRODUCT_IMAGE_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+PRODUCT_IMAGE_QUALITY = 82
+PRODUCT_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+PRODUCT_IMAGE_FETCH_TIMEOUT = 10
+PRODUCT_IMAGE_RETRY_BASE = 600
+PRODUCT_IMAGE_RETRY_MAX = 86400
+PRODUCT_IMAGE_MAX_FAILURES = 8
+MEDIA_DIR = os.environ.get('MEDIA_DIR', os.path.join(app.instance_path, 'media'))
+PRODUCT_IMAGE_DIR = os.path.join(MEDIA_DIR, 'products')
+_PRODUCT_IMAGE_NAME_RE = re.compile(r'^[0-9a-f]+-(sm|md|lg)\.(webp|jpg)$')
+
+@app.template_global()
+def product_image_path(image_hash, size='md', fmt='jpg'):
+    return f'/media/products/{image_hash}-{size}.{fmt}'
+
+@app.template_global()
+def product_image_srcset(image_hash, fmt):
+    return ', '.join(f'{product_image_path(image_hash, size, fmt)} {width}w'
+                     for size, width in PRODUCT_IMAGE_SIZES.items())
+
+def product_display_image(product):
+    """商品的顯示圖片，有本地縮圖時優先使用"""
+    if product.image_hash:
+        return product_image_path(product.image_hash)
+    return product.image_url
+
+def store_product_image(data):
+    """產生各尺寸縮圖並回傳內容雜湊，相同內容不會重複處理"""
+    image_hash = hashlib.sha256(data).hexdigest()[:20]
+    targets = [(size, width, ext, fmt) for size, width in PRODUCT_IMAGE_SIZES.items()
+               for ext, fmt in PRODUCT_IMAGE_FORMATS.items()]
+    if all(os.path.exists(os.path.join(PRODUCT_IMAGE_DIR, f'{image_hash}-{size}.{ext}'))
+           for size, _, ext, _ in targets):
+        return image_hash
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except Exception:
+        raise ValueError('無效的圖片檔案')
+
+    os.makedirs(PRODUCT_IMAGE_DIR, exist_ok=True)
+    for size, width, ext, fmt in targets:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((width, width), Image.LANCZOS)
+        path = os.path.join(PRODUCT_IMAGE_DIR, f'{image_hash}-{size}.{ext}')
+        # 先寫暫存檔再改名，避免其他 worker 讀到寫到一半的檔案
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        thumbnail.save(tmp_path, fmt, quality=PRODUCT_IMAGE_QUALITY)
+        os.replace(tmp_path, path)
+    return image_hash
+
+def _quote_url(url):
+    """把路徑與查詢字串中的非 ASCII 字元（例如預設圖片網址的中文）轉為百分比編碼，已編碼的部分保持不變"""
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.quote(parts.path, safe="/%:@!$&'()*+,;=")
+    query = urllib.parse.quote(parts.query, safe="/%:@!$&'()*+,;=?")
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, query, parts.fragment))
+
+def _create_public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """解析主機後只連線到公開網路位址，避免圖片網址被用來存取本機、內網或雲端 metadata 服務"""
+    host, port = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        ip = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError('圖片網址不可指向內部網路位址')
+    error = None
+    for family, socktype, proto, _, sockaddr in infos:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError(f'無法連線到 {host}')
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_public_connection
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_public_connection
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+# 下載圖片專用：不經過環境變數設定的代理、只支援 http/https，轉址後的每次連線同樣檢查位址
+_image_opener = urllib.request.OpenerDirector()
+for _handler in (_PublicHTTPHandler(), _PublicHTTPSHandler(), urllib.request.HTTPRedirectHandler(),
+                 urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPErrorProcessor()):
+    _image_opener.add_handler(_handler)
+
+def fetch_product_image(url):
+    if not url or not url.startswith(('http://', 'https://')):
+        raise ValueError('圖片網址必須以 http:// 或 https:// 開頭')
+    req = urllib.request.Request(_quote_url(url), headers={'User-Agent': 'restaurant-system/1.0'})
+    with _image_opener.open(req, timeout=PRODUCT_IMAGE_FETCH_TIMEOUT) as resp:
+        data = resp.read(PRODUCT_IMAGE_MAX_BYTES + 1)
+    if len(data) > PRODUCT_IMAGE_MAX_BYTES:
+        raise ValueError('圖片檔案過大')
+    return data
+
+def reset_image_fetch_failures(product):
+    product.image_fetch_failures = None
+    product.image_fetch_retry_at = None
+
+def cache_product_images():
+    """下載尚未快取的遠端商品圖片並產生縮圖，只有第一次失敗的商品會讓任務回報錯誤"""
+    errors = []
+    now = datetime.utcnow()
+    # 圖片以內容雜湊共用，不分分店
+    products = Product.query.filter(
+        Product.image_hash.is_(None),
+        db.or_(Product.image_fetch_retry_at.is_(None), Product.image_fetch_retry_at <= now),
+        db.or_(Product.image_fetch_failures.is_(None), Product.image_fetch_failures < PRODUCT_IMAGE_MAX_FAILURES)
+    ).all()
+    for product in products:
+        if not product.image_url or not product.image_url.startswith(('http://', 'https://')):
+            continue
+        product_id = product.id
+        try:
+            product.image_hash = store_product_image(fetch_product_image(product.image_url))
+            reset_image_fetch_failures(product)
+            bump_catalog_version(product.store_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            product = db.session.get(Product, product_id)
+            failures = (product.image_fetch_failures or 0) + 1
+            product.image_fetch_failures = failures
+            delay = min(PRODUCT_IMAGE_RETRY_BASE * 2 ** (failures - 1), PRODUCT_IMAGE_RETRY_MAX)
+            product.image_fetch_retry_at = datetime.utcnow() + timedelta(seconds=delay)
+            db.session.commit()
+            if failures == 1:
+                errors.append(f'商品 {product_id}: {e}')
+            else:
+                app.logger.warning('商品 %s 圖片第 %s 次下載失敗：%s', product_id, failures, e)
+    if errors:
+        raise RuntimeError('; '.join(errors))
+
+@scheduled_job('cache_product_images', 300)
+def cache_product_images_job():
+    cache_product_images()
+
+@app.route('/media/products/<name>')
+def product_image(name):
+    if not _PRODUCT_IMAGE_NAME_RE.match(name):
+        return app.response_class('Not Found', status=404, mimetype='text/plain')
+    response = send_from_directory(PRODUCT_IMAGE_DIR, name, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 # 用戶端路由
 @app.route('/')
 def index():
@@ -151,9 +1958,32 @@ def index():
 
 @app.route('/menu')
 def menu():
-    products = Product.query.all()
+    products = store_query(Product).all()
     return render_template('menu.html', products=products)
 
+@app.route('/api/menu')
+def api_menu():
+    """依分類分組的精簡菜單，可用 ?category=漢堡&category=飲品 或逗號分隔只取部分分類"""
+    payload, body = get_menu_payload()
+    wanted = [name.strip() for value in request.args.getlist('category')
+              for name in value.split(',') if name.strip()]
+
+    if wanted:
+        response = app.response_class(json.dumps({
+            'success': True,
+            'version': payload['version'],
+            'category_counts': payload['category_counts'],
+            'categories': [c for c in payload['categories'] if c['name'] in wanted]
+        }, ensure_ascii=False, separators=(',', ':')), mimetype='application/json')
+    else:
+        response = app.response_class(body, mimetype='application/json')
+
+    # 分類名稱為中文，不能直接放進標頭，以雜湊值區分不同篩選條件
+    filter_hash = hashlib.md5(','.join(sorted(wanted)).encode('utf-8')).hexdigest()[:8]
+    response.set_etag(f"menu-{current_store_id()}-{payload['version']}-{filter_hash}")
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
 @app.route('/cart')
 def cart():
     return render_template('cart.html')
@@ -164,7 +1994,7 @@ def add_to_cart():
         product_id = request.json.get('product_id')
         quantity = request.json.get('quantity', 1)
         
-        product = Product.query.get_or_404(product_id)
+        product = get_store_object_or_404(Product, product_id)
         
         cart = session.get('cart', [])
         
@@ -182,7 +2012,7 @@ def add_to_cart():
                 'name': product.name,
                 'price': product.price,
                 'quantity': quantity,
-                'image_url': product.image_url
+                'image_url': product_display_image(product)
             })
         
         session['cart'] = cart
@@ -237,6 +2067,34 @@ def checkout():
     total = sum(item['price'] * item['quantity'] for item in cart)
     return render_template('checkout.html', cart=cart, total=total)
 
+PENDING_ORDER_TTL = 1800
+
+# 送出訂單的冪等鍵
+# prepare_order 為每張待處理訂單產生一組鍵，submit_order 建立訂單時一併寫入 Order.idempotency_key（唯一索引）。
+# 連線不穩的手機重送時，先查本 worker 的短期快取，再以唯一索引查詢，找到就回傳原訂單編號，不會重複建立
+IDEMPOTENCY_CACHE_TTL = 600
+IDEMPOTENCY_CACHE_MAX_ENTRIES = 10000
+_idempotency_cache = OrderedDict()  # 冪等鍵 -> (到期時間, 訂單編號)
+_idempotency_cache_lock = threading.Lock()
+
+def remember_idempotent_order(key, order_id):
+    with _idempotency_cache_lock:
+        _idempotency_cache[key] = (time.monotonic() + IDEMPOTENCY_CACHE_TTL, order_id)
+        _idempotency_cache.move_to_end(key)
+        while len(_idempotency_cache) > IDEMPOTENCY_CACHE_MAX_ENTRIES:
+            _idempotency_cache.popitem(last=False)
+
+def find_idempotent_order(key):
+    """回傳此冪等鍵已建立的訂單編號，沒有則回傳 None"""
+    with _idempotency_cache_lock:
+        entry = _idempotency_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+    order_id = db.session.query(Order.id).filter(Order.idempotency_key == key).scalar()
+    if order_id is not None:
+        remember_idempotent_order(key, order_id)
+    return order_id
+
 @app.route('/api/prepare_order', methods=['POST'])
 def prepare_order():
     """準備訂單但不創建，將訂單信息存入session"""
@@ -257,17 +2115,31 @@ def prepare_order():
             'customer_phone': customer_phone,
             'dine_in': dine_in,
             'order_items': cart,
-            'total_price': total_price
+            'total_price': total_price,
+            'store_id': current_store_id(),
+            'idempotency_key': secrets.token_urlsafe(24),
+            'prepared_at': time.time()
         }
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'idempotency_key': session['pending_order']['idempotency_key']})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+def get_pending_order():
+    """取得 session 中的待處理訂單，超過 PENDING_ORDER_TTL 秒未付款視為過期並清除
+
+    待處理訂單存在用戶端的 session cookie 中，伺服器無法主動清除，只能在讀取時判斷
+    """
+    pending_order = session.get('pending_order')
+    if pending_order and time.time() - pending_order.get('prepared_at', time.time()) > PENDING_ORDER_TTL:
+        session.pop('pending_order', None)
+        return None
+    return pending_order
+
 @app.route('/payment')
 def payment():
     # 從session獲取待處理訂單信息
-    pending_order = session.get('pending_order')
+    pending_order = get_pending_order()
     if not pending_order:
         flash('沒有待處理的訂單')
         return redirect(url_for('menu'))
@@ -282,13 +2154,44 @@ def payment():
             self.order_items = json.dumps(order_data['order_items'])
     
     order = MockOrder(pending_order)
-    return render_template('payment.html', order=order)
+    return render_template('payment.html', order=order,
+                           idempotency_key=pending_order.get('idempotency_key', ''))
 
 @app.route('/api/submit_order', methods=['POST'])
 def submit_order():
-    """在支付頁面確認支付後創建訂單"""
+    """在支付頁面確認支付後創建訂單
+
+    可在 Idempotency-Key 標頭或 idempotency_key 欄位帶入 prepare_order 發出的冪等鍵，
+    重送時回傳原訂單編號；session 中的待處理訂單已清除或過期也能辨識。
+    session 中有待處理訂單時一律使用它自己的鍵，只有鍵相符時才清除購物車與待處理訂單
+    """
     try:
-        pending_order = session.get('pending_order')
+        pending_order = get_pending_order()
+        pending_key = (pending_order or {}).get('idempotency_key')
+        client_key = (request.headers.get('Idempotency-Key')
+                      or (request.get_json(silent=True) or {}).get('idempotency_key'))
+        if client_key and len(client_key) > 64:
+            return jsonify({'success': False, 'message': '無效的冪等鍵'})
+
+        if client_key and pending_key and client_key != pending_key:
+            # 返回鍵或快取的舊付款頁面：只回報舊鍵已建立的訂單，不動目前的購物車與待處理訂單
+            with store_context(current_store_id()):
+                order_id = find_idempotent_order(client_key)
+            if order_id is not None:
+                return jsonify({'success': True, 'order_id': order_id})
+            return jsonify({'success': False, 'message': '付款頁面已過期，請重新整理'})
+
+        idempotency_key = pending_key or client_key
+        if idempotency_key:
+            store_id = (pending_order or {}).get('store_id') or current_store_id()
+            with store_context(store_id):
+                order_id = find_idempotent_order(idempotency_key)
+            if order_id is not None:
+                if pending_key == idempotency_key:
+                    session.pop('cart', None)
+                    session.pop('pending_order', None)
+                return jsonify({'success': True, 'order_id': order_id})
+
         if not pending_order:
             return jsonify({'success': False, 'message': '沒有待處理的訂單'})
         
@@ -303,11 +2206,30 @@ def submit_order():
             customer_phone=customer_phone,
             order_items=json.dumps(cart),
             total_price=total_price,
-            dine_in=dine_in
+            dine_in=dine_in,
+            store_id=pending_order.get('store_id') or current_store_id(),
+            idempotency_key=idempotency_key
         )
         
         db.session.add(order)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 同一個冪等鍵的請求同時送達，另一個請求已建立訂單
+            db.session.rollback()
+            if not idempotency_key:
+                raise
+            with store_context(order.store_id):
+                order_id = find_idempotent_order(idempotency_key)
+            if order_id is None:
+                raise
+            if pending_key == idempotency_key:
+                session.pop('cart', None)
+                session.pop('pending_order', None)
+            return jsonify({'success': True, 'order_id': order_id})
+        if idempotency_key:
+            remember_idempotent_order(idempotency_key, order.id)
+        invalidate_reports(order.store_id)
         
         # 清空session中的購物車和待處理訂單
         session.pop('cart', None)
@@ -319,12 +2241,12 @@ def submit_order():
 
 @app.route('/order_success/<int:order_id>')
 def order_success(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = get_store_object_or_404(Order, order_id)
     return render_template('order_success.html', order=order)
 
 @app.route('/order_status/<int:order_id>')
 def order_status(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = get_store_object_or_404(Order, order_id)
     # 解析訂單項目
     try:
         order_items = json.loads(order.order_items)
@@ -362,54 +2284,60 @@ def admin_dashboard():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    # 統計資料
-    total_orders = Order.query.count()
-    pending_orders = Order.query.filter_by(status='待處理').count()
-    today_orders = Order.query.filter(Order.created_at >= datetime.utcnow().date()).count()
-    today_revenue = db.session.query(db.func.sum(Order.total_price)).filter(
-        Order.created_at >= datetime.utcnow().date()
-    ).scalar() or 0
+    def compute():
+        # 統計資料
+        total_orders = store_query(Order).count()
+        pending_orders = store_query(Order).filter_by(status='待處理').count()
+        today_orders = store_query(Order).filter(Order.created_at >= datetime.utcnow().date()).count()
+        today_revenue = db.session.query(db.func.sum(Order.total_price)).filter(
+            Order.store_id == current_store_id(),
+            Order.created_at >= datetime.utcnow().date()
+        ).scalar() or 0
     
-    # 熱銷商品排行
-    today = datetime.utcnow().date()
-    orders_today = Order.query.filter(Order.created_at >= today).all()
+        # 熱銷商品排行
+        today = datetime.utcnow().date()
+        orders_today = store_query(Order).filter(Order.created_at >= today).all()
     
-    # 分析熱銷商品
-    product_sales = {}
-    for order in orders_today:
-        try:
-            items = json.loads(order.order_items)
-            for item in items:
-                product_id = item['id']
-                quantity = item['quantity']
-                if product_id in product_sales:
-                    product_sales[product_id]['quantity'] += quantity
-                    product_sales[product_id]['revenue'] += item['price'] * quantity
-                else:
-                    product_sales[product_id] = {
-                        'name': item['name'],
-                        'quantity': quantity,
-                        'revenue': item['price'] * quantity
-                    }
-        except:
-            continue
+        # 分析熱銷商品
+        product_sales = {}
+        for order in orders_today:
+            try:
+                items = json.loads(order.order_items)
+                for item in items:
+                    product_id = item['id']
+                    quantity = item['quantity']
+                    if product_id in product_sales:
+                        product_sales[product_id]['quantity'] += quantity
+                        product_sales[product_id]['revenue'] += item['price'] * quantity
+                    else:
+                        product_sales[product_id] = {
+                            'name': item['name'],
+                            'quantity': quantity,
+                            'revenue': item['price'] * quantity
+                        }
+            except:
+                continue
     
-    # 轉換為列表並排序
-    top_products = sorted(product_sales.values(), key=lambda x: x['quantity'], reverse=True)[:5]
+        # 轉換為列表並排序
+        top_products = sorted(product_sales.values(), key=lambda x: x['quantity'], reverse=True)[:5]
     
-    return render_template('admin_dashboard.html', 
-                         total_orders=total_orders,
-                         pending_orders=pending_orders,
-                         today_orders=today_orders,
-                         today_revenue=today_revenue,
-                         top_products=top_products)
+        return {
+            'total_orders': total_orders,
+            'pending_orders': pending_orders,
+            'today_orders': today_orders,
+            'today_revenue': today_revenue,
+            'top_products': top_products
+        }
+
+    # 同時開啟總覽的請求共用同一次計算，結果短暫快取
+    return render_template('admin_dashboard.html', **cached_report('dashboard', compute))
 
 @app.route('/admin/products')
 def admin_products():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    products = Product.query.all()
+    products = store_query(Product).all()
     return render_template('admin_products.html', products=products)
 
 @app.route('/admin/orders')
@@ -417,9 +2345,96 @@ def admin_orders():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    products = Product.query.all()  # 获取所有商品
-    return render_template('admin_orders.html', orders=orders, products=products)
+    before_id = request.args.get('before', type=int)
+    orders, next_before = order_list_page(before_id)
+    products = store_query(Product).all()  # 获取所有商品
+    return render_template('admin_orders.html', orders=orders, products=products,
+                           before_id=before_id, next_before=next_before)
+
+@app.route('/api/admin/search/orders')
+def search_orders():
+    """依顧客姓名、電話、訂單編號或商品名稱搜尋訂單，以 before 參數做 keyset 分頁"""
+    if not session.get('admin_logged_in') and not session.get('cashier_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    keyword, before_id, per_page = _search_page_args()
+    if not keyword:
+        return jsonify({'success': False, 'message': '請輸入搜尋關鍵字'})
+
+    # 第一頁已把完全符合的訂單編號放在最前面，之後的頁面不再重複出現
+    exact_id = int(keyword) if keyword.isdigit() else None
+    items_text = db.cast(db.cast(Order.order_items, JSONB), db.Text)
+    ids = _search_ids('order_search', ['customer_name', 'customer_phone', 'order_ref', 'item_names'],
+                      Order, [Order.customer_name, Order.customer_phone, items_text],
+                      keyword, before_id, per_page + 1, exclude_id=exact_id if before_id else None)
+
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    next_before = ids[-1] if has_more else None
+
+    # 完全符合的訂單編號放在第一頁最前面
+    if exact_id is not None and not before_id:
+        if exact_id not in ids and store_query(Order).filter(Order.id == exact_id).first():
+            ids.insert(0, exact_id)
+    orders_by_id = {order.id: order for order in store_query(Order).filter(Order.id.in_(ids))} if ids else {}
+
+    orders_data = []
+    for order_id in ids:
+        order = orders_by_id.get(order_id)
+        if order is None:
+            continue
+        orders_data.append({
+            'id': order.id,
+            'customer_name': order.customer_name,
+            'customer_phone': order.customer_phone,
+            'total_price': order.total_price,
+            'status': order.status,
+            'created_at': order.created_at,
+            'dine_in': order.dine_in
+        })
+
+    return jsonify({
+        'success': True,
+        'orders': orders_data,
+        'next_before': next_before
+    })
+
+@app.route('/api/admin/search/products')
+def search_products():
+    """依商品名稱或分類搜尋商品，以 before 參數做 keyset 分頁"""
+    if not session.get('admin_logged_in') and not session.get('cashier_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    keyword, before_id, per_page = _search_page_args()
+    if not keyword:
+        return jsonify({'success': False, 'message': '請輸入搜尋關鍵字'})
+
+    ids = _search_ids('product_search', ['name', 'category'],
+                      Product, [Product.name, Product.category],
+                      keyword, before_id, per_page + 1)
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    products_by_id = {product.id: product for product in store_query(Product).filter(Product.id.in_(ids))} if ids else {}
+
+    products_data = []
+    for product_id in ids:
+        product = products_by_id.get(product_id)
+        if product is None:
+            continue
+        products_data.append({
+            'id': product.id,
+            'name': product.name,
+            'price': product.price,
+            'category': product.category,
+            'stock': product.stock,
+            'image_url': product.image_url
+        })
+
+    return jsonify({
+        'success': True,
+        'products': products_data,
+        'next_before': ids[-1] if has_more else None
+    })
 
 @app.route('/api/admin/add_product', methods=['POST'])
 def add_product():
@@ -433,14 +2448,16 @@ def add_product():
         stock = int(request.json.get('stock', 99))
         category = request.json.get('category', '主餐')
         
-        product = Product(name=name, price=price, image_url=image_url, stock=stock, category=category)
+        product = Product(name=name, price=price, image_url=image_url, stock=stock, category=category,
+                          store_id=current_store_id())
         db.session.add(product)
+        bump_catalog_version()
         db.session.commit()
         
         # 記錄操作日誌
         log_operation('admin', session.get('admin_id'), '新增商品', f'商品名稱: {name}')
         
-        return jsonify({'success': True, 'message': '商品新增成功'})
+        return jsonify({'success': True, 'message': '商品新增成功', 'product_id': product.id})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -450,14 +2467,20 @@ def update_product(product_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        product = Product.query.get_or_404(product_id)
+        product = get_store_object_or_404(Product, product_id)
         
         product.name = request.json.get('name', product.name)
         product.price = float(request.json.get('price', product.price))
-        product.image_url = request.json.get('image_url', product.image_url)
+        image_url = request.json.get('image_url', product.image_url)
+        if image_url != product.image_url:
+            # 圖片網址變更後由背景任務重新下載縮圖
+            product.image_url = image_url
+            product.image_hash = None
+            reset_image_fetch_failures(product)
         product.stock = int(request.json.get('stock', product.stock))
         product.category = request.json.get('category', product.category)
         
+        bump_catalog_version()
         db.session.commit()
         
         # 記錄操作日誌
@@ -467,14 +2490,50 @@ def update_product(product_id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/api/admin/product_image/<int:product_id>', methods=['POST'])
+def upload_product_image(product_id):
+    """上傳商品圖片（multipart 的 image 欄位）或提供 image_url 由伺服器下載"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    try:
+        product = get_store_object_or_404(Product, product_id)
+
+        upload = request.files.get('image')
+        if upload:
+            data = upload.read(PRODUCT_IMAGE_MAX_BYTES + 1)
+            if len(data) > PRODUCT_IMAGE_MAX_BYTES:
+                return jsonify({'success': False, 'message': '圖片檔案過大'})
+        else:
+            image_url = (request.get_json(silent=True) or {}).get('image_url')
+            data = fetch_product_image(image_url)
+            product.image_url = image_url
+
+        product.image_hash = store_product_image(data)
+        reset_image_fetch_failures(product)
+        if upload:
+            product.image_url = product_image_path(product.image_hash)
+        bump_catalog_version()
+        db.session.commit()
+
+        # 記錄操作日誌
+        log_operation('admin', session.get('admin_id'), '更新商品圖片', f'商品ID: {product_id}')
+
+        return jsonify({'success': True, 'message': '圖片更新成功',
+                        'image_url': product_image_path(product.image_hash)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
+
 @app.route('/api/admin/delete_product/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     if not session.get('admin_logged_in'):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        product = Product.query.get_or_404(product_id)
+        product = get_store_object_or_404(Product, product_id)
         db.session.delete(product)
+        bump_catalog_version()
         db.session.commit()
         
         # 記錄操作日誌
@@ -490,7 +2549,7 @@ def update_order_status(order_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        order = Order.query.get_or_404(order_id)
+        order = get_store_object_or_404(Order, order_id)
         new_status = request.json.get('status')
         
         if new_status in ['待處理', '製作中', '完成']:
@@ -501,6 +2560,7 @@ def update_order_status(order_id):
                 order.cashier_id = session.get('cashier_id')
             
             db.session.commit()
+            invalidate_reports()
             
             # 記錄操作日誌
             user_type = 'cashier' if session.get('cashier_logged_in') else 'admin'
@@ -520,9 +2580,12 @@ def delete_order(order_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        order = Order.query.get_or_404(order_id)
+        order = get_store_object_or_404(Order, order_id)
+        invalidate_daily_sales(order.created_at)
+        record_demand_rows_patch(order_id)
         db.session.delete(order)
         db.session.commit()
+        invalidate_reports()
         
         # 記錄操作日誌
         user_type = 'cashier' if session.get('cashier_logged_in') else 'admin'
@@ -540,7 +2603,7 @@ def update_order_info(order_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        order = Order.query.get_or_404(order_id)
+        order = get_store_object_or_404(Order, order_id)
         
         order.customer_name = request.json.get('customer_name', order.customer_name)
         order.customer_phone = request.json.get('customer_phone', order.customer_phone)
@@ -563,7 +2626,7 @@ def update_order_items(order_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        order = Order.query.get_or_404(order_id)
+        order = get_store_object_or_404(Order, order_id)
         new_items = request.json.get('order_items')
         
         # 計算新總價
@@ -572,8 +2635,11 @@ def update_order_items(order_id):
         # 更新訂單項目和總價
         order.order_items = json.dumps(new_items)
         order.total_price = total_price
+        invalidate_daily_sales(order.created_at)
+        record_demand_rows_patch(order_id)
         
         db.session.commit()
+        invalidate_reports()
         
         # 記錄操作日誌
         user_type = 'cashier' if session.get('cashier_logged_in') else 'admin'
@@ -584,6 +2650,21 @@ def update_order_items(order_id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/api/admin/order_items')
+def api_order_items():
+    """批次取得訂單項目，ids 以逗號分隔，供列表頁展開詳情時載入"""
+    if not session.get('admin_logged_in') and not session.get('cashier_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    ids = [int(value) for value in request.args.get('ids', '').split(',') if value.strip().isdigit()]
+    if not ids:
+        return jsonify({'success': False, 'message': '請提供訂單編號'})
+    if len(ids) > ORDER_ITEMS_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'一次最多查詢 {ORDER_ITEMS_BATCH_LIMIT} 筆訂單'})
+
+    items_by_id = load_order_items(ids)
+    return jsonify({'success': True, 'items': {str(order_id): items for order_id, items in items_by_id.items()}})
+
 @app.route('/api/check_new_orders')
 def check_new_orders():
     if not session.get('admin_logged_in') and not session.get('cashier_logged_in'):
@@ -592,7 +2673,7 @@ def check_new_orders():
     last_check = session.get('last_order_check', datetime.utcnow() - timedelta(minutes=5))
 
     # 查找新訂單（最近5分鐘內創建的且尚未通知過）
-    new_orders = Order.query.filter(
+    new_orders = store_query(Order).filter(
         Order.created_at > last_check,
         Order.status == '待處理',
         Order.notified == False  # 只抓尚未通知過的訂單
@@ -632,71 +2713,114 @@ def admin_reports():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    # 今日報表
-    today = datetime.utcnow().date()
-    today_orders = Order.query.filter(Order.created_at >= today).all()
-    today_revenue = sum(order.total_price for order in today_orders)
-    
-    # 本月報表
-    this_month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    month_orders = Order.query.filter(Order.created_at >= this_month_start).all()
-    month_revenue = sum(order.total_price for order in month_orders)
-    
-    # 最近7天的銷售數據
-    week_data = []
-    for i in range(7):
-        date = datetime.utcnow().date() - timedelta(days=i)
-        day_orders = Order.query.filter(
-            Order.created_at >= date,
-            Order.created_at < date + timedelta(days=1)
-        ).all()
-        week_data.append({
-            'date': date.strftime('%Y-%m-%d'),
-            'orders': len(day_orders),
-            'revenue': sum(order.total_price for order in day_orders)
-        })
-    
-    # 熱銷商品排行 (最近30天)
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    orders_30_days = Order.query.filter(Order.created_at >= thirty_days_ago).all()
-    
-    # 分析熱銷商品
-    product_sales = {}
-    for order in orders_30_days:
-        try:
-            items = json.loads(order.order_items)
-            for item in items:
-                product_id = item['id']
-                quantity = item['quantity']
+    def compute():
+        # 過去日期讀取 DailySales 彙總，只有今天即時計算
+        today = datetime.utcnow().date()
+        this_month_start = today.replace(day=1)
+        first_day = min(this_month_start, today - timedelta(days=29))
+        days = [first_day + timedelta(days=i) for i in range((today - first_day).days + 1)]
+        daily = get_daily_sales(days)
+
+        # 今日報表
+        today_orders = daily[today]['order_count']
+        today_revenue = daily[today]['revenue']
+
+        # 本月報表
+        month_days = [day for day in days if day >= this_month_start]
+        month_orders = sum(daily[day]['order_count'] for day in month_days)
+        month_revenue = sum(daily[day]['revenue'] for day in month_days)
+
+        # 最近7天的銷售數據
+        week_data = []
+        for i in range(7):
+            date = today - timedelta(days=i)
+            week_data.append({
+                'date': date.strftime('%Y-%m-%d'),
+                'orders': daily[date]['order_count'],
+                'revenue': daily[date]['revenue']
+            })
+
+        # 熱銷商品排行 (最近30天)
+        product_sales = {}
+        for i in range(30):
+            for product_id, sales in daily[today - timedelta(days=i)]['product_sales'].items():
                 if product_id in product_sales:
-                    product_sales[product_id]['quantity'] += quantity
-                    product_sales[product_id]['revenue'] += item['price'] * quantity
+                    product_sales[product_id]['quantity'] += sales['quantity']
+                    product_sales[product_id]['revenue'] += sales['revenue']
                 else:
-                    product_sales[product_id] = {
-                        'name': item['name'],
-                        'quantity': quantity,
-                        'revenue': item['price'] * quantity
-                    }
-        except:
+                    product_sales[product_id] = dict(sales)
+
+        # 轉換為列表並排序
+        top_products = sorted(product_sales.values(), key=lambda x: x['quantity'], reverse=True)
+
+        return {
+            'today_orders': today_orders,
+            'today_revenue': today_revenue,
+            'month_orders': month_orders,
+            'month_revenue': month_revenue,
+            'week_data': list(reversed(week_data)),
+            'top_products': top_products
+        }
+
+    # 同時開啟報表的請求共用同一次計算，結果短暫快取
+    return render_template('admin_reports.html', **cached_report('reports', compute))
+
+@app.route('/admin/forecast')
+def admin_forecast():
+    """依過去一年同星期、同時段的銷量預測某一天各商品的需求，供備料參考"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    today = datetime.now(tz).date()
+    try:
+        day = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        day = today + timedelta(days=1)
+    day = min(max(day, today), today + timedelta(days=FORECAST_MAX_DAYS_AHEAD))
+
+    hourly, product_ids, profile = forecast_demand(day)
+    products = {product.id: product for product in
+                store_query(Product).with_entities(Product.id, Product.name, Product.category)}
+
+    forecasts = []
+    for column, product_id in enumerate(product_ids):
+        product = products.get(product_id)
+        by_hour = hourly[:, column]
+        total = float(by_hour.sum())
+        # 已刪除的商品不需備料
+        if product is None or total <= 0:
             continue
-    
-    # 轉換為列表並排序
-    top_products = sorted(product_sales.values(), key=lambda x: x['quantity'], reverse=True)
-    
-    return render_template('admin_reports.html',
-                         today_orders=len(today_orders),
-                         today_revenue=today_revenue,
-                         month_orders=len(month_orders),
-                         month_revenue=month_revenue,
-                         week_data=list(reversed(week_data)),
-                         top_products=top_products)
+        forecasts.append({
+            'name': product.name,
+            'category': product.category,
+            'total': total,
+            'prep_quantity': int(np.ceil(round(total, 1))),
+            'shifts': [float(by_hour[start:end].sum()) for _, start, end in FORECAST_SHIFTS],
+            'peak_hour': int(by_hour.argmax())
+        })
+    forecasts.sort(key=lambda x: x['total'], reverse=True)
+
+    # 各小時所有商品的預估總量，用於顯示尖峰時段
+    hourly_totals = hourly[:, [column for column, product_id in enumerate(product_ids)
+                               if product_id in products]].sum(axis=1)
+    return render_template('admin_forecast.html',
+                         day=day,
+                         today=today,
+                         max_day=today + timedelta(days=FORECAST_MAX_DAYS_AHEAD),
+                         forecasts=forecasts,
+                         shifts=FORECAST_SHIFTS,
+                         hourly_totals=hourly_totals.tolist(),
+                         hourly_max=float(hourly_totals.max()) if len(hourly_totals) else 0,
+                         window_days=FORECAST_WINDOW_DAYS,
+                         order_item_count=profile['order_item_count'],
+                         computed_at=profile['computed_at'])
 
 @app.route('/admin/cashiers')
 def admin_cashiers():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    cashiers = Cashier.query.all()
+    cashiers = store_query(Cashier).all()
     return render_template('admin_cashiers.html', cashiers=cashiers)
 
 @app.route('/api/admin/add_cashier', methods=['POST'])
@@ -708,14 +2832,15 @@ def add_cashier():
         username = request.json.get('username')
         password = request.json.get('password')
         
-        # 檢查用戶名是否已存在
+        # 檢查用戶名是否已存在（收銀員以帳號登入，帳號不分分店皆不可重複）
         existing_cashier = Cashier.query.filter_by(username=username).first()
         if existing_cashier:
             return jsonify({'success': False, 'message': '用戶名已存在'})
         
         cashier = Cashier(
             username=username,
-            password_hash=generate_password_hash(password)
+            password_hash=generate_password_hash(password),
+            store_id=current_store_id()
         )
         
         db.session.add(cashier)
@@ -734,7 +2859,7 @@ def update_cashier(cashier_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        cashier = Cashier.query.get_or_404(cashier_id)
+        cashier = get_store_object_or_404(Cashier, cashier_id)
         
         if 'username' in request.json:
             # 檢查用戶名是否已存在（排除自己）
@@ -768,7 +2893,7 @@ def delete_cashier(cashier_id):
         return jsonify({'success': False, 'message': '未登入'})
     
     try:
-        cashier = Cashier.query.get_or_404(cashier_id)
+        cashier = get_store_object_or_404(Cashier, cashier_id)
         db.session.delete(cashier)
         db.session.commit()
         
@@ -784,13 +2909,112 @@ def admin_operation_logs():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
     
-    page = request.args.get('page', 1, type=int)
     per_page = 20
-    
-    logs = OperationLog.query.order_by(OperationLog.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False)
-    
-    return render_template('admin_operation_logs.html', logs=logs)
+    before_id = request.args.get('before', type=int)
+    after_id = request.args.get('after', type=int)
+    filters = {
+        'user_type': request.args.get('user_type', '').strip(),
+        'user_id': request.args.get('user_id', '').strip(),
+        'action': request.args.get('action', '').strip(),
+        'start_date': request.args.get('start_date', '').strip(),
+        'end_date': request.args.get('end_date', '').strip()
+    }
+
+    query = OperationLog.query
+    if filters['user_type']:
+        query = query.filter(OperationLog.user_type == filters['user_type'])
+    if filters['user_id'].isdigit():
+        query = query.filter(OperationLog.user_id == int(filters['user_id']))
+    if filters['action']:
+        query = query.filter(OperationLog.action == filters['action'])
+    # 日期以本地時間 (GMT+8) 輸入，轉換為 UTC 比對
+    try:
+        if filters['start_date']:
+            start = tz.localize(datetime.strptime(filters['start_date'], '%Y-%m-%d'))
+            query = query.filter(OperationLog.created_at >= start.astimezone(timezone('UTC')).replace(tzinfo=None))
+        if filters['end_date']:
+            end = tz.localize(datetime.strptime(filters['end_date'], '%Y-%m-%d') + timedelta(days=1))
+            query = query.filter(OperationLog.created_at < end.astimezone(timezone('UTC')).replace(tzinfo=None))
+    except ValueError:
+        flash('日期格式錯誤')
+
+    # keyset 分頁：before 往較舊的頁面，after 往較新的頁面，避免 COUNT(*) 與深層 OFFSET
+    if after_id:
+        logs = query.filter(OperationLog.id > after_id).order_by(OperationLog.id.asc()).limit(per_page + 1).all()
+        has_newer = len(logs) > per_page
+        logs = list(reversed(logs[:per_page]))
+        has_older = bool(logs)
+    else:
+        if before_id:
+            query = query.filter(OperationLog.id < before_id)
+        logs = query.order_by(OperationLog.id.desc()).limit(per_page + 1).all()
+        has_older = len(logs) > per_page
+        logs = logs[:per_page]
+        has_newer = bool(before_id) and bool(logs)
+
+    pagination = {
+        'newer': logs[0].id if logs and has_newer else None,
+        'older': logs[-1].id if logs and has_older else None
+    }
+    query_args = {key: value for key, value in filters.items() if value}
+
+    return render_template('admin_operation_logs.html', logs=logs, pagination=pagination,
+                           filters=filters, query_args=query_args)
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    reports = []
+    for name in list_profile_reports():
+        report = load_profile_report(name)
+        if report:
+            report.pop('queries', None)
+            report.pop('stats', None)
+            report['created_at'] = datetime.fromisoformat(report['created_at'])
+            reports.append(report)
+    return render_template('admin_profiles.html', reports=reports, ring_size=PROFILE_RING_SIZE)
+
+@app.route('/admin/profiles/<name>')
+def admin_profile_detail(name):
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    report = load_profile_report(name)
+    if report is None:
+        flash('找不到分析報告')
+        return redirect(url_for('admin_profiles'))
+    report['created_at'] = datetime.fromisoformat(report['created_at'])
+    return render_template('admin_profile_detail.html', report=report)
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    jobs = ScheduledJob.query.order_by(ScheduledJob.name).all()
+    return render_template('admin_jobs.html', jobs=jobs, scheduler_enabled=SCHEDULER_ENABLED)
+
+@app.route('/api/admin/run_job/<name>', methods=['POST'])
+def run_job_now(name):
+    """讓任務在下一次排程檢查時立即執行"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    try:
+        updated = ScheduledJob.query.filter_by(name=name).update(
+            {ScheduledJob.next_run_at: datetime.utcnow()}, synchronize_session=False)
+        if not updated:
+            return jsonify({'success': False, 'message': '找不到任務'})
+        db.session.commit()
+
+        # 記錄操作日誌
+        log_operation('admin', session.get('admin_id'), '執行背景任務', f'任務: {name}')
+
+        return jsonify({'success': True, 'message': '任務將於下次排程檢查時執行'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
 
 @app.route('/admin/cashier_performance')
 def admin_cashier_performance():
@@ -798,24 +3022,25 @@ def admin_cashier_performance():
         return redirect(url_for('admin_login'))
     
     # 獲取所有收銀員
-    cashiers = Cashier.query.all()
+    cashiers = store_query(Cashier).all()
+    
+    # 以 GROUP BY 一次計算所有收銀員的訂單數量和總金額，不載入訂單本身
+    def totals_by_cashier(*conditions):
+        rows = store_query(Order).with_entities(
+            Order.cashier_id, db.func.count(Order.id), db.func.sum(Order.total_price)
+        ).filter(Order.cashier_id.isnot(None), *conditions).group_by(Order.cashier_id)
+        return {cashier_id: (count, revenue or 0) for cashier_id, count, revenue in rows}
+
+    totals = totals_by_cashier()
+    # 計算最近30天的訂單
+    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+    recent_totals = totals_by_cashier(Order.created_at >= thirty_days_ago)
     
     # 計算每個收銀員的績效
     cashier_performance = []
     for cashier in cashiers:
-        # 計算訂單數量和總金額
-        orders = Order.query.filter_by(cashier_id=cashier.id).all()
-        order_count = len(orders)
-        total_revenue = sum(order.total_price for order in orders)
-        
-        # 計算最近30天的訂單
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        recent_orders = Order.query.filter(
-            Order.cashier_id == cashier.id,
-            Order.created_at >= thirty_days_ago
-        ).all()
-        recent_order_count = len(recent_orders)
-        recent_revenue = sum(order.total_price for order in recent_orders)
+        order_count, total_revenue = totals.get(cashier.id, (0, 0))
+        recent_order_count, recent_revenue = recent_totals.get(cashier.id, (0, 0))
         
         cashier_performance.append({
             'id': cashier.id,
@@ -830,6 +3055,109 @@ def admin_cashier_performance():
     
     return render_template('admin_cashier_performance.html', cashier_performance=cashier_performance)
 
+# 分店路由
+@app.route('/store/<code>')
+def select_store(code):
+    """顧客選擇分店，購物車中的商品屬於原分店，一併清空"""
+    store = get_store_by_code(code)
+    if store is None or not store['is_active']:
+        flash('找不到此分店')
+        return redirect(url_for('menu'))
+    if session.get('cashier_logged_in'):
+        flash('收銀員只能使用所屬分店')
+        return redirect(url_for('menu'))
+
+    if session.get('store_id') != store['id']:
+        session['store_id'] = store['id']
+        session.pop('cart', None)
+        session.pop('pending_order', None)
+    return redirect(url_for('menu'))
+
+@app.route('/admin/stores')
+def admin_stores():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    stores = Store.query.order_by(Store.id).all()
+    return render_template('admin_stores.html', stores=stores,
+                           partition_mode=STORE_PARTITION_MODE)
+
+@app.route('/api/admin/add_store', methods=['POST'])
+def add_store():
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'message': '未登入'})
+
+    try:
+        code = (request.json.get('code') or '').strip().lower()
+        name = (request.json.get('name') or '').strip()
+
+        # 代碼會用於網址與分區資料庫檔名
+        if not re.fullmatch(r'[a-z0-9_-]{1,20}', code):
+            return jsonify({'success': False, 'message': '分店代碼只能使用小寫英文、數字、- 或 _'})
+        if not name:
+            return jsonify({'success': False, 'message': '請輸入分店名稱'})
+        if Store.query.filter_by(code=code).first():
+            return jsonify({'success': False, 'message': '分店代碼已存在'})
+
+        store = Store(code=code, name=name)
+        db.session.add(store)
+        bump_version_counter('stores_version')
+        db.session.commit()
+        invalidate_stores()
+        init_store_partition(store.id)
+
+        # 記錄操作日誌
+        log_operation('admin', session.get('admin_id'), '新增分店', f'分店: {code} {name}')
+
+        return jsonify({'success': True, 'message': '分店新增成功', 'store_id': store.id})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/admin/switch_store/<int:store_id>', methods=['POST'])
+def admin_switch_store(store_id):
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    store = get_store(store_id)
+    if store is None:
+        flash('找不到此分店')
+    else:
+        session['store_id'] = store_id
+        flash(f"已切換至 {store['name']}")
+    # 只接受本站的後台路徑，避免被當成開放轉址
+    next_path = request.form.get('next') or ''
+    if not next_path.startswith('/admin') or next_path.startswith('//') or '\\' in next_path:
+        next_path = url_for('admin_dashboard')
+    return redirect(next_path)
+
+@app.route('/admin/store_reports')
+def admin_store_reports():
+    """各分店最近30天的營收比較，每家分店讀取自己的 DailySales 彙總"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    today = datetime.utcnow().date()
+    days = [today - timedelta(days=i) for i in range(29, -1, -1)]
+    store_rows = []
+    for store in get_stores():
+        with store_context(store['id']):
+            daily = get_daily_sales(days)
+        store_rows.append({
+            'store': store,
+            'today_orders': daily[today]['order_count'],
+            'today_revenue': daily[today]['revenue'],
+            'week_orders': sum(daily[day]['order_count'] for day in days[-7:]),
+            'week_revenue': sum(daily[day]['revenue'] for day in days[-7:]),
+            'month_orders': sum(daily[day]['order_count'] for day in days),
+            'month_revenue': sum(daily[day]['revenue'] for day in days)
+        })
+
+    totals = {key: sum(row[key] for row in store_rows)
+              for key in ('today_orders', 'today_revenue', 'week_orders', 'week_revenue',
+                          'month_orders', 'month_revenue')}
+    return render_template('admin_store_reports.html', store_rows=store_rows, totals=totals)
+
 @app.route('/admin/logout')
 def admin_logout():
     # 記錄登出日誌
@@ -859,6 +3187,7 @@ def cashier_login_api():
         session['cashier_username'] = username
         session['cashier_id'] = cashier.id
         session['user_type'] = 'cashier'
+        session['store_id'] = cashier.store_id
         
         # 記錄登入日誌
         log_operation('cashier', cashier.id, '收銀員登入')
@@ -874,12 +3203,13 @@ def cashier_dashboard():
     
     # 獲取當前收銀員的訂單統計
     cashier_id = session.get('cashier_id')
-    total_orders = Order.query.filter_by(cashier_id=cashier_id).count()
-    today_orders = Order.query.filter(
+    total_orders = store_query(Order).filter_by(cashier_id=cashier_id).count()
+    today_orders = store_query(Order).filter(
         Order.cashier_id == cashier_id,
         Order.created_at >= datetime.utcnow().date()
     ).count()
     today_revenue = db.session.query(db.func.sum(Order.total_price)).filter(
+        Order.store_id == current_store_id(),
         Order.cashier_id == cashier_id,
         Order.created_at >= datetime.utcnow().date()
     ).scalar() or 0
@@ -894,14 +3224,15 @@ def cashier_orders():
     if not session.get('cashier_logged_in'):
         return redirect(url_for('cashier_login'))
     
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    products = Product.query.all()
+    before_id = request.args.get('before', type=int)
+    orders, next_before = order_list_page(before_id)
+    products = store_query(Product).all()
     
     # 獲取通知自動關閉時間設置
-    notification_timeout = SystemSetting.query.filter_by(key='notification_timeout').first()
-    timeout_seconds = int(notification_timeout.value) if notification_timeout else 10
+    timeout_seconds = get_setting('notification_timeout')
     
-    return render_template('cashier_orders.html', orders=orders, products=products, timeout_seconds=timeout_seconds)
+    return render_template('cashier_orders.html', orders=orders, products=products, timeout_seconds=timeout_seconds,
+                           before_id=before_id, next_before=next_before)
 
 @app.route('/cashier/logout')
 def cashier_logout():
@@ -913,6 +3244,7 @@ def cashier_logout():
     session.pop('cashier_username', None)
     session.pop('cashier_id', None)
     session.pop('user_type', None)
+    session.pop('store_id', None)
     return redirect(url_for('cashier_login'))
 
 # 系統設置API
@@ -924,27 +3256,85 @@ def update_setting():
     try:
         key = request.json.get('key')
         value = request.json.get('value')
-        
-        setting = SystemSetting.query.filter_by(key=key).first()
+        # store_scope 為真時只套用到目前分店
+        store_scope = bool(request.json.get('store_scope'))
+
+        if not key or '@' in key or key in VERSION_SETTING_KEYS:
+            return jsonify({'success': False, 'message': '無效的設置項'})
+        if value is None:
+            return jsonify({'success': False, 'message': '設置值不可為空'})
+        value = str(value)
+        if key in SETTING_TYPES and SETTING_TYPES[key][0] is int:
+            try:
+                int(value)
+            except ValueError:
+                return jsonify({'success': False, 'message': '設置值必須為整數'})
+
+        stored_key = store_setting_key(key, current_store_id()) if store_scope else key
+        setting = SystemSetting.query.filter_by(key=stored_key).first()
         if setting:
             setting.value = value
         else:
-            setting = SystemSetting(key=key, value=value)
+            setting = SystemSetting(key=stored_key, value=value)
             db.session.add(setting)
-        
+
+        bump_version_counter('settings_version')
         db.session.commit()
+        invalidate_settings()
         
         # 記錄操作日誌
-        log_operation('admin', session.get('admin_id'), '更新系統設置', f'設置項: {key}, 值: {value}')
+        log_operation('admin', session.get('admin_id'), '更新系統設置', f'設置項: {stored_key}, 值: {value}')
         
         return jsonify({'success': True, 'message': '設置更新成功'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+def ensure_columns(model, engine=None):
+    """create_all 不會替既有資料表補欄位，以 ALTER TABLE 補上新增的可為空欄位"""
+    engine = engine or db.engine
+    table = model.__table__
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute(db.text(
+                    f'ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} '
+                    f'{column.type.compile(dialect=engine.dialect)}'
+                ))
+
 # 初始化資料庫和示例資料
 def init_db():
     with app.app_context():
         db.create_all()
+
+        # DailySales 改以（分店, 日期）為主鍵，舊表只是可重算的彙總，直接重建
+        if 'store_id' not in {column['name'] for column in inspect(db.engine).get_columns('daily_sales')}:
+            DailySales.__table__.drop(db.engine)
+            DailySales.__table__.create(db.engine)
+
+        for model in (Product, Order, Cashier, DailySales):
+            ensure_columns(model)
+
+        # create_all 不會替既有資料表補建索引
+        for model in (OperationLog, Product, Order, Cashier):
+            for index in model.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
+
+        # 建立總店，並把分店功能加入前的資料歸到總店
+        default_store = Store.query.filter_by(code=DEFAULT_STORE_CODE).first()
+        if default_store is None:
+            default_store = Store(code=DEFAULT_STORE_CODE, name='總店')
+            db.session.add(default_store)
+            db.session.flush()
+            bump_version_counter('stores_version')
+        for model in (Product, Order, Cashier):
+            model.query.filter(model.store_id.is_(None)).update(
+                {model.store_id: default_store.id}, synchronize_session=False)
+
+        # 修正早期示例資料中格式錯誤的圖片網址
+        Product.query.filter_by(image_url='https://images.unsplash.com-1547592180-85f173990554?w=300&h=200&fit=crop').update(
+            {Product.image_url: 'https://images.unsplash.com/photo-1547592180-85f173990554?w=300&h=200&fit=crop'}, synchronize_session=False)
         
         # 檢查是否已有管理員帳號
         if not Admin.query.first():
@@ -970,7 +3360,7 @@ def init_db():
                 Product(name='沙拉', price=85, category='輕食', image_url='https://images.unsplash.com/photo-1512621776951-a57141f2eefd?w=300&h=200&fit=crop'),
                 Product(name='三明治', price=75, category='輕食', image_url='https://images.unsplash.com/photo-1539252554453-80ab65ce3586?w=300&h=200&fit=crop'),
                 Product(name='比薩', price=180, category='主餐', image_url='https://images.unsplash.com/photo-1565299624946-b28f40a0ca4b?w=300&h=200&fit=crop'),
-                Product(name='湯品', price=40, category='配餐', image_url='https://images.unsplash.com-1547592180-85f173990554?w=300&h=200&fit=crop'),
+                Product(name='湯品', price=40, category='配餐', image_url='https://images.unsplash.com/photo-1547592180-85f173990554?w=300&h=200&fit=crop'),
                 Product(name='甜點', price=65, category='甜點', image_url='https://images.unsplash.com/photo-1551024506-0bccd828d307?w=300&h=200&fit=crop'),
                 Product(name='冰淇淋', price=55, category='甜點', image_url='https://images.unsplash.com/photo-1567206563064-6f60f40a2b57?w=300&h=200&fit=crop'),
                 Product(name='蛋糕', price=85, category='甜點', image_url='https://images.unsplash.com/photo-1578985545062-69928b1d9587?w=300&h=200&fit=crop'),
@@ -980,15 +3370,89 @@ def init_db():
             ]
             
             for product in sample_products:
+                product.store_id = default_store.id
                 db.session.add(product)
         
         # 檢查是否已有系統設置
         if not SystemSetting.query.filter_by(key='notification_timeout').first():
             setting = SystemSetting(key='notification_timeout', value='10')
             db.session.add(setting)
-        
+
         db.session.commit()
 
-if __name__ == '__main__':
+        # 建立搜尋索引（放在示例資料之後，首次建立時會一併回填）
+        init_search_index()
+
+        invalidate_stores()
+        for store in get_stores():
+            init_store_partition(store['id'])
+
+        sync_scheduled_jobs()
+
+# 應用程式初始化
+# 搭配 gunicorn preload_app（見 gunicorn.conf.py）：資料庫檢查、示例資料與快取預熱
+# 只在 master 執行一次，fork 出的 worker 以 copy-on-write 共用已載入的菜單與已編譯的模板
+_worker_state = {'forked_at': None, 'first_request_done': False}
+
+def warm_caches():
+    """預先載入菜單與系統設置快取，並編譯所有模板"""
+    started = time.monotonic()
+    with app.app_context():
+        for store in get_stores():
+            with store_context(store['id']):
+                get_menu_payload()
+        warm_demand_rows()
+        _refresh_settings(force=True)
+        for name in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(name)
+        # fork 前關閉連線池，讓每個 worker 建立自己的資料庫連線
+        db.engine.dispose()
+        dispose_store_engines()
+    app.logger.info('快取預熱完成，耗時 %.1f ms', (time.monotonic() - started) * 1000)
+
+def init_app_once():
+    """初始化資料庫並預熱快取後回傳模組層級的 app，重複呼叫直接回傳同一個 app。
+    這不是應用程式工廠：每次呼叫都是同一個 app 與同一份快取狀態"""
+    if app.config.get('WARMED_UP'):
+        return app
+
+    # 在 gunicorn 下沿用其日誌設定，預熱與啟動耗時才會出現在 gunicorn 日誌中
+    gunicorn_logger = logging.getLogger('gunicorn.error')
+    if gunicorn_logger.handlers:
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+
     init_db()
+    warm_caches()
+    app.config['WARMED_UP'] = True
+    return app
+
+def mark_worker_forked():
+    """由 gunicorn post_fork 呼叫，記錄 worker 的啟動時間"""
+    _worker_state['forked_at'] = time.monotonic()
+    _worker_state['first_request_done'] = False
+
+@app.before_request
+def track_first_request():
+    if not _worker_state['first_request_done']:
+        request.environ['first_request_started_at'] = time.monotonic()
+
+@app.after_request
+def report_first_request(response):
+    started = request.environ.get('first_request_started_at')
+    if started is not None and not _worker_state['first_request_done']:
+        _worker_state['first_request_done'] = True
+        now = time.monotonic()
+        if _worker_state['forked_at'] is not None:
+            app.logger.info('worker %s 第一個請求 %s 處理耗時 %.1f ms（距 fork %.1f ms）',
+                            os.getpid(), request.path, (now - started) * 1000,
+                            (now - _worker_state['forked_at']) * 1000)
+        else:
+            app.logger.info('worker %s 第一個請求 %s 處理耗時 %.1f ms',
+                            os.getpid(), request.path, (now - started) * 1000)
+    return response
+
+if __name__ == '__main__':
+    init_app_once()
+    start_scheduler()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
@@ -0,0 +1,34 @@
+# gunicorn.conf.py - gunicorn 設定
+# 在 master 中先建立 app（資料庫初始化與快取預熱只做一次），再 fork 出 worker
+import gc
+import os
+import time
+
+wsgi_app = 'app:init_app_once()'
+preload_app = True
+
+# 負載保護（app.py 的 MAX_IN_FLIGHT）以 worker 內的執行緒為單位計算進行中的請求，
+# 必須使用多執行緒 worker，且每個 worker 的執行緒數要大於 MAX_IN_FLIGHT，
+# 否則進行中的請求數到不了門檻，503 與保留給商家端的名額都不會生效
+# 報表快取（ReportCache）合併相同計算也只在同一 worker 的執行緒之間，threads 為 1 時不會合併
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', int(os.environ.get('MAX_IN_FLIGHT', 32)) + 8))
+
+
+def when_ready(server):
+    # 預熱完成的物件移出 GC 追蹤，避免 worker 因垃圾回收寫入而破壞 copy-on-write 共享
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.mark_worker_forked()
+    # 排程執行緒無法跨 fork 保留，每個 worker 各自啟動
+    app.start_scheduler()
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    worker.log.info('worker %s 啟動完成，耗時 %.1f ms',
+                    worker.pid, (time.monotonic() - worker.forked_at) * 1000)